@@ -0,0 +1,325 @@
+"""
+In-memory chat session store for /chat/support.
+
+Each session keeps a small ring buffer of recent turns, the entities resolved so
+far (order number, last intent) and the order state fetched for that order, so
+follow-up turns are answered without another database round trip. Sessions are
+evicted after an idle timeout and the store never holds more than
+``max_sessions`` of them (least recently used sessions go first).
+
+Chat history is persisted to the ``chat_messages`` Mongo collection in batches
+by ``ChatHistoryWriter`` instead of one insert per message. Documents need the
+order the conversation is about, so turns are held in the session until its
+order has been resolved and are then written together.
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+import db
+
+logger = logging.getLogger(__name__)
+
+ORDER_TOKEN = r"#?\s*([A-Za-z0-9-]*\d[A-Za-z0-9-]*)"
+# "#12345", "order number 12345", "order no. ORD-1001", "order id: 42"
+EXPLICIT_ORDER_PATTERNS = (
+    re.compile(r"#\s*([A-Za-z0-9-]*\d[A-Za-z0-9-]*)"),
+    re.compile(r"\border\s+(?:number|no\.?|id)\s*(?:is\s+|:\s*)?" + ORDER_TOKEN, re.IGNORECASE),
+)
+# A message that is nothing but the number, answering "please provide your order number"
+BARE_ORDER_PATTERN = re.compile(r"^\s*" + ORDER_TOKEN + r"\s*[.!]?\s*$")
+MIN_ORDER_NUMBER_LENGTH = 3
+# Orders in these states no longer change, so their cached state never goes stale
+FINAL_ORDER_STATUSES = ("delivered", "cancelled")
+
+
+def extract_order_number(message: str, allow_bare: bool = True) -> Optional[str]:
+    """
+    Pull an order number out of a chat message, if the user explicitly gave one.
+
+    Only ``#...``, "order number ..." style references count; numbers that merely
+    appear in the text ("150 minutes late", "7:30pm") are ignored. With
+    ``allow_bare`` a message consisting of only the number also counts.
+    """
+    patterns = EXPLICIT_ORDER_PATTERNS + ((BARE_ORDER_PATTERN,) if allow_bare else ())
+    for pattern in patterns:
+        match = pattern.search(message)
+        if match and len(match.group(1)) >= MIN_ORDER_NUMBER_LENGTH:
+            return match.group(1)
+    return None
+
+
+class ChatSession:
+    """Compact per-session state: recent turns, resolved entities and order state."""
+
+    __slots__ = (
+        "session_id", "user_id", "turns", "order_number", "last_intent", "order_state", "last_seen",
+        "pending_history", "order_fetched_at",
+    )
+
+    def __init__(self, session_id: str, user_id=None, max_turns: int = 10, max_pending_history: int = 50):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.turns = deque(maxlen=max_turns)
+        self.order_number: Optional[str] = None
+        self.last_intent: Optional[str] = None
+        self.order_state: Optional[dict] = None
+        self.order_fetched_at: Optional[float] = None
+        self.last_seen = time.monotonic()
+        # (sender_type, message, timestamp) not yet written because no order is resolved
+        self.pending_history = deque(maxlen=max_pending_history)
+
+    def add_turn(self, role: str, text: str, intent: Optional[str] = None):
+        self.turns.append((role, text, intent))
+
+
+class ChatSessionStore:
+    """Bounded LRU store of chat sessions with idle-time eviction."""
+
+    def __init__(
+        self,
+        max_sessions: int = 10000,
+        idle_ttl_seconds: float = 1800,
+        max_turns: int = 10,
+        max_message_chars: int = 500,
+        order_state_ttl_seconds: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+        on_evict: Optional[Callable[[ChatSession], None]] = None,
+    ):
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.max_turns = max_turns
+        self.max_message_chars = max_message_chars
+        self.order_state_ttl_seconds = order_state_ttl_seconds
+        self._clock = clock
+        self._on_evict = on_evict
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def session_key(context: Optional[dict]) -> Optional[str]:
+        """Derive the session key from the request context, or None if stateless."""
+        if not context:
+            return None
+        if context.get("session_id"):
+            return f"session:{context['session_id']}"
+        if context.get("user_id") is not None:
+            return f"user:{context['user_id']}"
+        return None
+
+    def get_or_create(self, key: str, user_id=None) -> ChatSession:
+        now = self._clock()
+        with self._lock:
+            self._evict_idle(now)
+            session = self._sessions.get(key)
+            if session is None:
+                session = ChatSession(key, user_id=user_id, max_turns=self.max_turns)
+                self._sessions[key] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._evict_oldest()
+            else:
+                self._sessions.move_to_end(key)
+            session.last_seen = now
+            return session
+
+    def get(self, key: str) -> Optional[ChatSession]:
+        with self._lock:
+            return self._sessions.get(key)
+
+    def set_order_state(self, session: ChatSession, order_state: Optional[dict]):
+        """Cache fetched order state; an empty dict records a lookup that found nothing."""
+        session.order_state = order_state or {}
+        session.order_fetched_at = self._clock()
+
+    def order_state_stale(self, session: ChatSession) -> bool:
+        """True if the session's order state must be (re)fetched before answering."""
+        if session.order_state is None or session.order_fetched_at is None:
+            return True
+        if session.order_state.get("status") in FINAL_ORDER_STATUSES:
+            return False
+        return self._clock() - session.order_fetched_at >= self.order_state_ttl_seconds
+
+    def clip(self, text: str) -> str:
+        return text[: self.max_message_chars]
+
+    def _evict_idle(self, now: float):
+        # Sessions are kept in last-seen order, so expired ones are at the front.
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.last_seen < self.idle_ttl_seconds:
+                break
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        _, session = self._sessions.popitem(last=False)
+        if self._on_evict is not None:
+            self._on_evict(session)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class OrderLookupError(Exception):
+    """The order database could not be queried (as opposed to the order not existing)."""
+
+
+class PostgresOrderLoader:
+    """
+    Fetch order state by order number, reusing a single Postgres connection.
+
+    Returns None when no such order exists and raises ``OrderLookupError`` when
+    Postgres cannot be reached or the query fails, so callers do not mistake an
+    outage for an unknown order.
+    """
+
+    QUERY = (
+        "SELECT id, order_number, status, estimated_delivery_time, actual_delivery_time "
+        "FROM orders WHERE order_number = %s"
+    )
+
+    def __init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def __call__(self, order_number: str) -> Optional[dict]:
+        with self._lock:
+            try:
+                if self._conn is None or self._conn.closed:
+                    self._conn = db.get_postgres_connection()
+                if self._conn is None:
+                    raise OrderLookupError("Postgres is not available")
+                with self._conn.cursor() as cur:
+                    cur.execute(self.QUERY, (order_number,))
+                    row = cur.fetchone()
+                self._conn.rollback()
+            except OrderLookupError:
+                raise
+            except Exception as e:
+                logger.exception("Order lookup failed for %s", order_number)
+                self._reset()
+                raise OrderLookupError(str(e)) from e
+        return dict(row) if row else None
+
+    def _reset(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+
+def describe_order(order_number: str, order_state: dict, intent: str) -> str:
+    """Answer an order-status or delivery question from prefetched order state."""
+    if intent == "delivery_inquiry":
+        if order_state.get("actual_delivery_time"):
+            return f"Order #{order_number} was delivered at {order_state['actual_delivery_time']:%H:%M}."
+        if order_state.get("estimated_delivery_time"):
+            return f"Order #{order_number} is expected to arrive around {order_state['estimated_delivery_time']:%H:%M}."
+    status = str(order_state.get("status") or "pending").replace("_", " ")
+    return f"Your order #{order_number} is currently {status}."
+
+
+class ChatHistoryWriter:
+    """Buffer chat turns and insert them into ``chat_messages`` in batches."""
+
+    def __init__(
+        self,
+        collection=None,
+        batch_size: int = 100,
+        flush_interval_seconds: float = 5.0,
+        max_buffer: int = 10000,
+    ):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_buffer = max_buffer
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        # Turns that could not be persisted (no order/user, or dropped under backpressure)
+        self.skipped = 0
+
+    @classmethod
+    def from_env(cls, **kwargs) -> "ChatHistoryWriter":
+        database = db.get_mongo_database()
+        collection = database["chat_messages"] if database is not None else None
+        return cls(collection=collection, **kwargs)
+
+    @staticmethod
+    def build_document(order_id, sender_id, sender_type: str, text: str, timestamp: datetime) -> dict:
+        """Build a ``chat_messages`` document for a turn about the given ``orders.id``."""
+        return {
+            "order_id": order_id,
+            "sender_id": sender_id,
+            "sender_type": sender_type,
+            "message": text,
+            "message_type": "text",
+            "timestamp": timestamp,
+            "read_by": [],
+            "attachments": [],
+        }
+
+    def record_turn(self, session: ChatSession, sender_type: str, text: str) -> bool:
+        """
+        Queue a turn for persistence; returns True when a full batch is ready.
+
+        Turns wait in the session until its order is resolved (the order state
+        carries ``orders.id``), then every waiting turn is queued at once.
+        """
+        if self.collection is None:
+            return False
+        if len(session.pending_history) == session.pending_history.maxlen:
+            self._skip(1, "session pending history is full")
+        session.pending_history.append((sender_type, text, datetime.now(timezone.utc)))
+
+        order_id = (session.order_state or {}).get("id")
+        if order_id is None:
+            return False
+        turns = list(session.pending_history)
+        session.pending_history.clear()
+        if session.user_id is None:
+            self._skip(len(turns), "session has no user_id")
+            return False
+        documents = [
+            self.build_document(str(order_id), session.user_id, sender, message, timestamp)
+            for sender, message, timestamp in turns
+        ]
+        with self._lock:
+            # The buffer is bounded: if Mongo is not keeping up the oldest turns are dropped.
+            overflow = len(self._buffer) + len(documents) - self.max_buffer
+            self._buffer.extend(documents)
+            ready = len(self._buffer) >= self.batch_size
+        if overflow > 0:
+            self._skip(overflow, "write buffer is full")
+        return ready
+
+    def discard_session(self, session: ChatSession):
+        """Account for turns of an evicted session whose order was never resolved."""
+        if session.pending_history:
+            self._skip(len(session.pending_history), "session ended without a resolved order")
+            session.pending_history.clear()
+
+    def _skip(self, count: int, reason: str):
+        self.skipped += count
+        logger.debug("Skipped %d chat messages: %s", count, reason)
+
+    def flush(self) -> int:
+        """Insert all buffered documents in one batch; returns how many were written."""
+        with self._lock:
+            batch = list(self._buffer)
+            self._buffer.clear()
+        if not batch or self.collection is None:
+            return 0
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except Exception:
+            logger.exception("Failed to write %d chat messages", len(batch))
+            return 0
+        return len(batch)
+
+    def pending(self) -> int:
+        return len(self._buffer)
@@ -0,0 +1,345 @@
+"""
+Precomputed cold-start recommendation tiers.
+
+Users without order history get the same ranking for a given place and time, so
+ranked restaurant lists are built ahead of time per (geo cell x time-of-day bucket
+x dietary filter) and stored in one flat index array. A request is then a dict
+lookup plus a pass over the list that drops restaurants that are closed
+(``is_open``) or outside their ``operating_hours``.
+
+Tables are rebuilt in the background by ``main.py``; ``is_open`` flags are
+refreshed more often than the rankings because they change during the day.
+
+Time-of-day buckets and ``operating_hours`` are in restaurant-local time
+(``RESTAURANT_TIMEZONE``, default UTC). ``local_time`` converts to it, both for
+live requests and for replayed ones logged in UTC.
+"""
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import db
+
+logger = logging.getLogger(__name__)
+
+RESTAURANT_TIMEZONE = os.getenv("RESTAURANT_TIMEZONE", "UTC")
+GEO_CELL_DEGREES = 0.05  # ~5 km
+TOP_K = 50
+# Largest score boost from time-of-day demand, on the 0-1 rating scale (0.2 = one star)
+DEMAND_WEIGHT = 0.2
+GLOBAL_CELL = None
+
+# Bucket name -> hours of day it covers
+TIME_BUCKETS = {
+    "breakfast": range(5, 11),
+    "lunch": range(11, 15),
+    "afternoon": range(15, 17),
+    "dinner": range(17, 22),
+    "late_night": (22, 23, 0, 1, 2, 3, 4),
+}
+TIME_BUCKET_ALIASES = {
+    "morning": "breakfast",
+    "noon": "lunch",
+    "evening": "dinner",
+    "night": "late_night",
+}
+DIETARY_FILTERS = ("any", "vegetarian", "vegan", "gluten_free")
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+# Sentinels in the operating-hours array
+HOURS_UNKNOWN = -1
+HOURS_CLOSED = -2
+
+RESTAURANTS_QUERY = """
+    SELECT r.id, r.name, r.cuisine_type, r.rating, r.address, r.delivery_time_min, r.delivery_time_max,
+           r.is_open, r.operating_hours,
+           COALESCE(bool_or(m.is_vegetarian AND m.is_available), false) AS has_vegetarian,
+           COALESCE(bool_or(m.is_vegan AND m.is_available), false) AS has_vegan,
+           COALESCE(bool_or(m.is_gluten_free AND m.is_available), false) AS has_gluten_free
+    FROM restaurants r
+    LEFT JOIN menu_items m ON m.restaurant_id = r.id
+    WHERE r.is_active
+    GROUP BY r.id
+"""
+
+AVAILABILITY_QUERY = "SELECT id, is_open FROM restaurants WHERE is_active"
+
+KNOWN_USERS_PIPELINE = [
+    {"$match": {"event_type": "place_order"}},
+    {"$group": {"_id": "$user_id"}},
+]
+
+
+def local_time(moment: datetime = None) -> datetime:
+    """
+    ``moment`` (aware, or naive UTC as in the request log; default now) as a naive
+    datetime in ``RESTAURANT_TIMEZONE``.
+    """
+    if moment is None:
+        moment = datetime.now(timezone.utc)
+    elif moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    zone = timezone.utc if RESTAURANT_TIMEZONE == "UTC" else ZoneInfo(RESTAURANT_TIMEZONE)
+    return moment.astimezone(zone).replace(tzinfo=None)
+
+
+def time_bucket(time_of_day: Optional[str], now: datetime) -> str:
+    """Map a requested time of day (or the current hour) to a bucket name."""
+    if time_of_day:
+        name = time_of_day.strip().lower().replace(" ", "_").replace("-", "_")
+        name = TIME_BUCKET_ALIASES.get(name, name)
+        if name in TIME_BUCKETS:
+            return name
+    for name, hours in TIME_BUCKETS.items():
+        if now.hour in hours:
+            return name
+    return "late_night"
+
+
+def dietary_filter(user_preferences: Optional[dict]) -> str:
+    """Pick the most restrictive supported dietary filter from the preferences."""
+    dietary = (user_preferences or {}).get("dietary") or []
+    if isinstance(dietary, str):
+        dietary = [dietary]
+    elif not isinstance(dietary, (list, tuple)):
+        return "any"
+    # Preferences are free-form JSON; entries that are not strings are ignored
+    wanted = {d.strip().lower().replace("-", "_").replace(" ", "_") for d in dietary if isinstance(d, str)}
+    for name in ("vegan", "vegetarian", "gluten_free"):
+        if name in wanted:
+            return name
+    return "any"
+
+
+def geo_cell(location: Optional[dict]):
+    """Grid cell of a {"lat", "lng"} location, or None if it has no usable coordinates."""
+    if not isinstance(location, dict):
+        return None
+    try:
+        lat = float(location.get("lat", location.get("latitude")))
+        lng = float(location.get("lng", location.get("longitude")))
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lng)):
+        return None
+    return (math.floor(lat / GEO_CELL_DEGREES), math.floor(lng / GEO_CELL_DEGREES))
+
+
+def _parse_clock(value) -> int:
+    hours, minutes = str(value).split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_operating_hours(operating_hours) -> np.ndarray:
+    """
+    Convert ``operating_hours`` JSON into a (7, 2) array of open/close minutes.
+
+    Accepts ``{"monday": {"open": "09:00", "close": "22:00"}}`` or
+    ``{"monday": "09:00-22:00"}``; days set to null/"closed" are closed and
+    days that are missing or unparseable are treated as unknown (open).
+    """
+    hours = np.full((7, 2), HOURS_UNKNOWN, dtype=np.int16)
+    if not isinstance(operating_hours, dict):
+        return hours
+    days = {str(k).lower()[:3]: v for k, v in operating_hours.items()}
+    for index, weekday in enumerate(WEEKDAYS):
+        if weekday[:3] not in days:
+            continue
+        value = days[weekday[:3]]
+        try:
+            if not value or (isinstance(value, str) and value.lower() == "closed") or (
+                isinstance(value, dict) and value.get("closed")
+            ):
+                hours[index] = HOURS_CLOSED
+            elif isinstance(value, dict):
+                hours[index] = (_parse_clock(value["open"]), _parse_clock(value["close"]))
+            else:
+                opens, closes = str(value).split("-")
+                hours[index] = (_parse_clock(opens), _parse_clock(closes))
+        except (KeyError, ValueError):
+            continue
+    return hours
+
+
+class ColdStartTable:
+    """
+    Ranked restaurant lists for users without order history.
+
+    ``ranked`` is one int32 array of restaurant indices; ``slices`` maps
+    (cell, bucket, dietary) to the (start, stop) range of its list. Per-restaurant
+    data lives in parallel arrays indexed the same way.
+    """
+
+    def __init__(self, restaurants: list, ranked: np.ndarray, slices: dict, is_open: np.ndarray,
+                 hours: np.ndarray, known_users: np.ndarray, built_at: datetime = None):
+        self.restaurants = restaurants
+        self.ranked = ranked
+        self.slices = slices
+        self.is_open = is_open
+        self.hours = hours
+        self.known_users = known_users
+        self.built_at = built_at or datetime.now()
+        self._index = {r["id"]: i for i, r in enumerate(restaurants)}
+
+    @classmethod
+    def build(cls, rows: list, models: dict = None, known_users=(), top_k: int = TOP_K) -> "ColdStartTable":
+        """Rank restaurants for every (cell, bucket, dietary) combination they can serve."""
+        models = models or {}
+        demand = (models.get("demand") or {}).get("model", {})
+        popularity = (models.get("recommendations") or {}).get("model", {})
+
+        restaurants, cells, diets = [], [], []
+        ratings = np.zeros(len(rows), dtype=np.float32)
+        demand_by_bucket = np.zeros((len(rows), len(TIME_BUCKETS)), dtype=np.float32)
+        hours = np.full((len(rows), 7, 2), HOURS_UNKNOWN, dtype=np.int16)
+        is_open = np.zeros(len(rows), dtype=bool)
+
+        for i, row in enumerate(rows):
+            restaurant_id = str(row["id"])
+            stats = popularity.get(restaurant_id, {})
+            rating = float(stats.get("avg_rating") or row.get("rating") or 0)
+            cuisine = row.get("cuisine_type") or []
+            restaurants.append({
+                "id": restaurant_id,
+                "name": row["name"],
+                "cuisine": cuisine[0] if cuisine else None,
+                "rating": round(rating, 2),
+                "estimated_delivery": int(((row.get("delivery_time_min") or 30) + (row.get("delivery_time_max") or 45)) / 2),
+            })
+            hourly = (demand.get(restaurant_id) or {}).get("hourly_orders") or [0.0] * 24
+            ratings[i] = rating / 5
+            for b, bucket_hours in enumerate(TIME_BUCKETS.values()):
+                demand_by_bucket[i, b] = math.log1p(sum(hourly[h] for h in bucket_hours))
+            hours[i] = parse_operating_hours(row.get("operating_hours"))
+            is_open[i] = bool(row.get("is_open"))
+            cells.append(geo_cell(row.get("address")))
+            diets.append({"any"} | {d for d in DIETARY_FILTERS[1:] if row.get(f"has_{d}")})
+
+        # Score = rating on a 0-1 scale plus demand in that part of the day relative to
+        # the busiest restaurant, so demand can lift a restaurant by at most DEMAND_WEIGHT
+        peak = demand_by_bucket.max(axis=0) if len(rows) else np.zeros(len(TIME_BUCKETS), dtype=np.float32)
+        share = np.divide(demand_by_bucket, peak, out=np.zeros_like(demand_by_bucket), where=peak > 0)
+        scores = ratings[:, None] + DEMAND_WEIGHT * share
+
+        # Each restaurant is a candidate for its own cell and the eight around it
+        members = {GLOBAL_CELL: list(range(len(rows)))}
+        for i, cell in enumerate(cells):
+            if cell is None:
+                continue
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    members.setdefault((cell[0] + di, cell[1] + dj), []).append(i)
+
+        chunks, slices, offset = [], {}, 0
+        for cell, candidates in members.items():
+            candidates = np.asarray(candidates, dtype=np.int32)
+            for b, bucket in enumerate(TIME_BUCKETS):
+                order = candidates[np.argsort(-scores[candidates, b], kind="stable")]
+                for diet in DIETARY_FILTERS:
+                    ranked = [i for i in order if diet in diets[i]][:top_k]
+                    if not ranked:
+                        continue
+                    slices[(cell, bucket, diet)] = (offset, offset + len(ranked))
+                    chunks.append(np.asarray(ranked, dtype=np.int32))
+                    offset += len(ranked)
+
+        ranked = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+        known = np.unique(np.fromiter((int(u) for u in known_users if u is not None), dtype=np.int64))
+        return cls(restaurants, ranked, slices, is_open, hours, known)
+
+    def has_history(self, user_id: int) -> bool:
+        position = np.searchsorted(self.known_users, user_id)
+        return bool(position < len(self.known_users) and self.known_users[position] == user_id)
+
+    def is_available(self, index: int, now: datetime) -> bool:
+        if not self.is_open[index]:
+            return False
+        opens, closes = (int(v) for v in self.hours[index, now.weekday()])
+        if opens == HOURS_CLOSED:
+            return False
+        if opens == HOURS_UNKNOWN:
+            return True
+        minute = now.hour * 60 + now.minute
+        if opens <= closes:
+            return opens <= minute < closes
+        # Open past midnight
+        return minute >= opens or minute < closes
+
+    def lookup(self, location: Optional[dict], time_of_day: Optional[str], user_preferences: Optional[dict],
+               now: datetime = None, limit: int = 10) -> Optional[list]:
+        """
+        Return up to ``limit`` available restaurants for the request, or None when
+        the location's cell has no precomputed list. ``now`` is restaurant-local
+        time (see ``local_time``) and defaults to the current time.
+        """
+        now = now or local_time()
+        cell = geo_cell(location)
+        bucket = time_bucket(time_of_day, now)
+        key = (cell, bucket, dietary_filter(user_preferences))
+        if key not in self.slices:
+            if (cell, bucket, "any") not in self.slices:
+                return None
+            # The area is covered but nothing matches the dietary filter
+            return []
+        start, stop = self.slices[key]
+        results = []
+        for index in self.ranked[start:stop]:
+            if self.is_available(index, now):
+                results.append(dict(self.restaurants[index], reason=f"Popular nearby for {bucket.replace('_', ' ')}"))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def update_availability(self, rows):
+        """Refresh ``is_open`` flags in place from (id, is_open) rows."""
+        is_open = self.is_open.copy()
+        for row in rows:
+            index = self._index.get(str(row["id"]))
+            if index is not None:
+                is_open[index] = bool(row["is_open"])
+        self.is_open = is_open
+
+
+def load_cold_start_table(models: dict = None) -> Optional[ColdStartTable]:
+    """
+    Build a table from Postgres restaurants and Mongo order history, or None if
+    either is unavailable. Without the order history every user would look new,
+    so no table is built rather than sending users with history to cold start.
+    """
+    mongo_db = db.get_mongo_database()
+    if mongo_db is None:
+        logger.warning("MONGODB_URI is not configured; cold-start table disabled")
+        return None
+    conn = db.get_postgres_connection()
+    if conn is None:
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(RESTAURANTS_QUERY)
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    cursor = mongo_db["user_analytics"].aggregate(KNOWN_USERS_PIPELINE, allowDiskUse=True, batchSize=10000)
+    table = ColdStartTable.build(rows, models, (doc["_id"] for doc in cursor))
+    logger.info("Built cold-start table: %d restaurants, %d lists", len(table.restaurants), len(table.slices))
+    return table
+
+
+def refresh_availability(table: ColdStartTable) -> bool:
+    """Reload ``is_open`` flags for an existing table. Returns False if Postgres is unavailable."""
+    conn = db.get_postgres_connection()
+    if conn is None:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute(AVAILABILITY_QUERY)
+            table.update_availability(cur.fetchall())
+    finally:
+        conn.close()
+    return True
@@ -0,0 +1,38 @@
+"""
+Shared database handles for the AI service.
+
+The drivers are optional: when ``psycopg2``/``pymongo`` are not installed or the
+connection URLs are not configured, the getters return ``None`` and callers fall
+back to their stateless behaviour.
+"""
+import os
+from functools import lru_cache
+
+try:
+    import psycopg2
+    import psycopg2.extras
+except ImportError:  # pragma: no cover - optional dependency
+    psycopg2 = None
+
+try:
+    import pymongo
+except ImportError:  # pragma: no cover - optional dependency
+    pymongo = None
+
+
+def get_postgres_connection():
+    """Open a new Postgres connection using DATABASE_URL, or return None."""
+    url = os.getenv("DATABASE_URL")
+    if psycopg2 is None or not url:
+        return None
+    return psycopg2.connect(url, cursor_factory=psycopg2.extras.RealDictCursor)
+
+
+@lru_cache(maxsize=1)
+def get_mongo_database():
+    """Return the shared Mongo database handle from MONGODB_URI, or None."""
+    uri = os.getenv("MONGODB_URI")
+    if pymongo is None or not uri:
+        return None
+    client = pymongo.MongoClient(uri)
+    return client.get_default_database("ubereats")
@@ -1,16 +1,106 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Union
+from uuid import UUID
+from datetime import datetime
+import asyncio
+import logging
 import os
+import time
 from dotenv import load_dotenv
 
+from chat_sessions import (
+    ChatHistoryWriter,
+    ChatSessionStore,
+    OrderLookupError,
+    PostgresOrderLoader,
+    describe_order,
+    extract_order_number,
+)
+from cold_start import load_cold_start_table, refresh_availability
+from model_store import load_models
+from request_log import RequestLogger
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Chat session state shared across /chat/support turns
+chat_history_writer = ChatHistoryWriter.from_env(
+    batch_size=int(os.getenv("CHAT_HISTORY_BATCH_SIZE", "100")),
+    flush_interval_seconds=float(os.getenv("CHAT_HISTORY_FLUSH_SECONDS", "5")),
+)
+chat_sessions = ChatSessionStore(
+    max_sessions=int(os.getenv("CHAT_SESSION_MAX", "10000")),
+    idle_ttl_seconds=float(os.getenv("CHAT_SESSION_IDLE_SECONDS", "1800")),
+    max_turns=int(os.getenv("CHAT_SESSION_MAX_TURNS", "10")),
+    order_state_ttl_seconds=float(os.getenv("CHAT_ORDER_STATE_TTL_SECONDS", "60")),
+    on_evict=chat_history_writer.discard_session,
+)
+order_loader = PostgresOrderLoader() if os.getenv("DATABASE_URL") else None
+
+# Request bodies recorded for offline replay (replay_eval.py)
+request_logger = RequestLogger.from_env()
+
+# Latest artifacts published by training_pipeline.py, keyed by model name
+trained_models = load_models()
+
+# Precomputed rankings for users without order history, rebuilt in the background
+cold_start_table = None
+COLD_START_REBUILD_SECONDS = float(os.getenv("COLD_START_REBUILD_SECONDS", "900"))
+COLD_START_AVAILABILITY_SECONDS = float(os.getenv("COLD_START_AVAILABILITY_SECONDS", "60"))
+
+async def refresh_cold_start_tiers():
+    """Rebuild the cold-start table periodically and refresh is_open flags in between."""
+    global cold_start_table
+    last_build = None
+    while True:
+        try:
+            if cold_start_table is None or time.monotonic() - last_build >= COLD_START_REBUILD_SECONDS:
+                table = await run_in_threadpool(load_cold_start_table, trained_models)
+                if table is not None:
+                    cold_start_table = table
+                    last_build = time.monotonic()
+            else:
+                await run_in_threadpool(refresh_availability, cold_start_table)
+        except Exception:
+            logger.exception("Cold-start table refresh failed")
+        await asyncio.sleep(COLD_START_AVAILABILITY_SECONDS)
+
+async def flush_chat_history():
+    """Write partial chat history batches on a fixed interval, even when chat is quiet."""
+    while True:
+        await asyncio.sleep(chat_history_writer.flush_interval_seconds)
+        if chat_history_writer.pending():
+            try:
+                await run_in_threadpool(chat_history_writer.flush)
+            except Exception:
+                logger.exception("Chat history flush failed")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = [asyncio.create_task(flush_chat_history())]
+    if os.getenv("DATABASE_URL"):
+        tasks.append(asyncio.create_task(refresh_cold_start_tiers()))
+    yield
+    for task in tasks:
+        task.cancel()
+    # Persist any chat history and request logs still buffered on shutdown
+    await run_in_threadpool(chat_history_writer.flush)
+    await run_in_threadpool(request_logger.flush)
+
+async def log_request(endpoint: str, request: BaseModel):
+    if request_logger.log(endpoint, request.model_dump()):
+        await run_in_threadpool(request_logger.flush)
+
 app = FastAPI(
     title="UberEats AI Service",
     description="AI/ML service for recommendations, chat support, and analytics",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware
@@ -48,6 +138,58 @@ class ChatResponse(BaseModel):
 async def health_check():
     return {"status": "healthy", "service": "ai-service"}
 
+def recommend_restaurants(request: RecommendationRequest, table=None, now: datetime = None,
+                          has_history: Optional[bool] = None) -> dict:
+    """
+    Score restaurant recommendations for a request.
+
+    Users without order history are served from the precomputed cold-start
+    table for their area, time of day and dietary needs. ``table`` defaults to
+    the one maintained in the background and ``now`` to the current time;
+    ``has_history`` overrides the table's known users (replay passes whether
+    the user had ordered before the logged request).
+    """
+    if table is None:
+        table = cold_start_table
+    if has_history is None and table is not None:
+        has_history = table.has_history(request.user_id)
+    if table is not None and not has_history:
+        restaurants = table.lookup(request.location, request.time_of_day, request.user_preferences, now=now)
+        if restaurants is not None:
+            return {"restaurants": restaurants, "menu_items": [], "confidence_score": 0.6}
+
+    # Placeholder implementation - replace with actual ML model
+    return {
+        "restaurants": [
+            {
+                "id": 1,
+                "name": "Italian Bistro",
+                "cuisine": "Italian",
+                "rating": 4.5,
+                "estimated_delivery": 30,
+                "reason": "Based on your preference for Italian food"
+            },
+            {
+                "id": 2,
+                "name": "Sushi Palace",
+                "cuisine": "Japanese",
+                "rating": 4.7,
+                "estimated_delivery": 25,
+                "reason": "Highly rated nearby restaurant"
+            }
+        ],
+        "menu_items": [
+            {
+                "id": 101,
+                "name": "Margherita Pizza",
+                "restaurant_id": 1,
+                "price": 15.99,
+                "reason": "Popular choice for your preferences"
+            }
+        ],
+        "confidence_score": 0.85
+    }
+
 # Restaurant recommendations
 @app.post("/recommendations/restaurants", response_model=RecommendationResponse)
 async def get_restaurant_recommendations(request: RecommendationRequest):
@@ -56,38 +198,8 @@ async def get_restaurant_recommendations(request: RecommendationRequest):
     location, and past orders.
     """
     try:
-        # Placeholder implementation - replace with actual ML model
-        recommendations = {
-            "restaurants": [
-                {
-                    "id": 1,
-                    "name": "Italian Bistro",
-                    "cuisine": "Italian",
-                    "rating": 4.5,
-                    "estimated_delivery": 30,
-                    "reason": "Based on your preference for Italian food"
-                },
-                {
-                    "id": 2,
-                    "name": "Sushi Palace",
-                    "cuisine": "Japanese",
-                    "rating": 4.7,
-                    "estimated_delivery": 25,
-                    "reason": "Highly rated nearby restaurant"
-                }
-            ],
-            "menu_items": [
-                {
-                    "id": 101,
-                    "name": "Margherita Pizza",
-                    "restaurant_id": 1,
-                    "price": 15.99,
-                    "reason": "Popular choice for your preferences"
-                }
-            ],
-            "confidence_score": 0.85
-        }
-        return recommendations
+        await log_request("recommendations", request)
+        return recommend_restaurants(request)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -112,37 +224,102 @@ async def get_menu_recommendations(restaurant_id: int, user_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def classify_intent(text: str):
+    """
+    Keyword-based intent classification for chat messages.
+    Returns a (response, intent, confidence) tuple.
+    """
+    user_message = text.lower()
+
+    # Refund/cancellation requests (check first - highest priority)
+    if any(word in user_message for word in ["refund", "cancel", "money back", "return"]):
+        return (
+            "I understand you want to cancel or request a refund. Let me connect you with our support team.",
+            "refund_request",
+            0.88,
+        )
+    # Delivery time queries
+    if any(phrase in user_message for phrase in ["delivery", "how long", "delivery take", "time"]):
+        return (
+            "Typical delivery times are 25-40 minutes depending on your location and restaurant preparation time.",
+            "delivery_inquiry",
+            0.85,
+        )
+    # Order status queries (after refund/cancel to avoid conflicts)
+    if any(word in user_message for word in ["order", "where is my", "status", "track"]):
+        return (
+            "I can help you check your order status. Please provide your order number.",
+            "order_status",
+            0.9,
+        )
+    # General greetings and inquiries
+    return (
+        "I'm here to help! Can you please provide more details about your question?",
+        "general_inquiry",
+        0.6,
+    )
+
 # AI Chat Support
 @app.post("/chat/support", response_model=ChatResponse)
 async def chat_support(message: ChatMessage):
     """
     AI-powered chat support for customer queries.
+
+    When the context carries a session_id or user_id, the turn is answered
+    from the in-memory session: the order number given earlier and the order
+    state fetched for it are reused instead of querying again, until the
+    cached state is older than the session store's order-state TTL.
     """
     try:
-        # Improved intent classification logic with priority ordering
-        user_message = message.message.lower()
-        
-        # Refund/cancellation requests (check first - highest priority)
-        if any(word in user_message for word in ["refund", "cancel", "money back", "return"]):
-            response = "I understand you want to cancel or request a refund. Let me connect you with our support team."
-            intent = "refund_request"
-            confidence = 0.88
-        # Delivery time queries
-        elif any(phrase in user_message for phrase in ["delivery", "how long", "delivery take", "time"]):
-            response = "Typical delivery times are 25-40 minutes depending on your location and restaurant preparation time."
-            intent = "delivery_inquiry"
-            confidence = 0.85
-        # Order status queries (after refund/cancel to avoid conflicts)
-        elif any(word in user_message for word in ["order", "where is my", "status", "track"]):
-            response = "I can help you check your order status. Please provide your order number."
-            intent = "order_status"
-            confidence = 0.9
-        # General greetings and inquiries
-        else:
-            response = "I'm here to help! Can you please provide more details about your question?"
-            intent = "general_inquiry"
-            confidence = 0.6
-        
+        await log_request("chat", message)
+        response, intent, confidence = classify_intent(message.message)
+
+        key = ChatSessionStore.session_key(message.context)
+        if key is None:
+            return ChatResponse(response=response, intent=intent, confidence=confidence)
+
+        session = chat_sessions.get_or_create(key, user_id=message.context.get("user_id"))
+        # Explicit references (context, "#...", "order number ...") may switch orders;
+        # a message that is only a number is accepted only while no order is resolved
+        order_number = message.context.get("order_id") or extract_order_number(message.message, allow_bare=False)
+        if order_number is None and session.order_number is None:
+            order_number = extract_order_number(message.message)
+        if order_number is not None and str(order_number) != session.order_number:
+            session.order_number = str(order_number)
+            session.order_state = None
+            session.order_fetched_at = None
+
+        # A bare order number answers our previous "please provide your order number"
+        if intent == "general_inquiry" and order_number is not None and session.last_intent == "order_status":
+            intent, confidence = "order_status", 0.9
+
+        if intent in ("order_status", "delivery_inquiry") and session.order_number and order_loader is not None:
+            lookup_failed = False
+            if chat_sessions.order_state_stale(session):
+                # Reused for follow-ups until the TTL passes, or for good once the order is final
+                try:
+                    order_state = await run_in_threadpool(order_loader, session.order_number)
+                except OrderLookupError:
+                    # Not cached, so the next turn tries again
+                    lookup_failed = True
+                else:
+                    chat_sessions.set_order_state(session, order_state)
+            if session.order_state:
+                response = describe_order(session.order_number, session.order_state, intent)
+            elif lookup_failed:
+                response = f"I can't check order #{session.order_number} right now. Please try again in a moment."
+            elif intent == "order_status":
+                response = f"I couldn't find order #{session.order_number}. Please double-check the order number."
+
+        session.last_intent = intent
+        session.add_turn("customer", chat_sessions.clip(message.message), intent)
+        session.add_turn("support", response, intent)
+
+        flush_due = chat_history_writer.record_turn(session, "customer", message.message)
+        flush_due = chat_history_writer.record_turn(session, "support", response) or flush_due
+        if flush_due:
+            await run_in_threadpool(chat_history_writer.flush)
+
         return ChatResponse(
             response=response,
             intent=intent,
@@ -181,11 +358,32 @@ async def predict_price(request: PricePredictionRequest):
 
 # Demand forecasting
 @app.get("/analytics/demand-forecast")
-async def forecast_demand(restaurant_id: int, hours_ahead: int = 24):
+async def forecast_demand(restaurant_id: Union[int, UUID], hours_ahead: int = 24):
     """
     Forecast demand for a restaurant over the next specified hours.
+
+    restaurant_id is the restaurants.id UUID, which is how the trained demand
+    model is keyed; integer ids are still accepted.
     """
     try:
+        demand_model = trained_models.get("demand")
+        profile = demand_model["model"].get(str(restaurant_id)) if demand_model else None
+        if profile:
+            # Average orders per hour of day learned from order history
+            hourly = profile["hourly_orders"]
+            current_hour = datetime.now().hour
+            return {
+                "restaurant_id": restaurant_id,
+                "forecast_hours": hours_ahead,
+                "predicted_orders": [
+                    {"hour": i, "orders": hourly[(current_hour + i) % 24]} for i in range(hours_ahead)
+                ],
+                "peak_hours": sorted(sorted(range(24), key=lambda h: hourly[h], reverse=True)[:4]),
+                # More days of history make the hourly averages more reliable
+                "confidence": round(profile["days"] / (profile["days"] + 7), 2),
+                "model_version": demand_model["version"]
+            }
+
         # Placeholder implementation
         forecast = {
             "restaurant_id": restaurant_id,
@@ -205,6 +403,33 @@ async def forecast_demand(restaurant_id: int, hours_ahead: int = 24):
 class SentimentRequest(BaseModel):
     reviews: List[str]
 
+def score_review(review: str) -> dict:
+    """
+    Simple keyword-based sentiment for a single review (replace with actual model).
+    """
+    positive_words = ["good", "great", "excellent", "amazing", "love"]
+    negative_words = ["bad", "terrible", "awful", "hate", "worst"]
+
+    positive_count = sum(1 for word in positive_words if word in review.lower())
+    negative_count = sum(1 for word in negative_words if word in review.lower())
+
+    if positive_count > negative_count:
+        sentiment = "positive"
+        score = 0.7 + (positive_count * 0.1)
+    elif negative_count > positive_count:
+        sentiment = "negative"
+        score = 0.3 - (negative_count * 0.1)
+    else:
+        sentiment = "neutral"
+        score = 0.5
+
+    return {
+        "review": review[:50] + "...",
+        "sentiment": sentiment,
+        "score": min(max(score, 0), 1),
+        "confidence": 0.75
+    }
+
 # Sentiment analysis for reviews
 @app.post("/analytics/sentiment")
 async def analyze_sentiment(request: SentimentRequest):
@@ -212,34 +437,8 @@ async def analyze_sentiment(request: SentimentRequest):
     Analyze sentiment of customer reviews and feedback.
     """
     try:
-        # Placeholder implementation
-        results = []
-        for review in request.reviews:
-            # Simple keyword-based sentiment (replace with actual model)
-            positive_words = ["good", "great", "excellent", "amazing", "love"]
-            negative_words = ["bad", "terrible", "awful", "hate", "worst"]
-            
-            positive_count = sum(1 for word in positive_words if word in review.lower())
-            negative_count = sum(1 for word in negative_words if word in review.lower())
-            
-            if positive_count > negative_count:
-                sentiment = "positive"
-                score = 0.7 + (positive_count * 0.1)
-            elif negative_count > positive_count:
-                sentiment = "negative"
-                score = 0.3 - (negative_count * 0.1)
-            else:
-                sentiment = "neutral"
-                score = 0.5
-            
-            results.append({
-                "review": review[:50] + "...",
-                "sentiment": sentiment,
-                "score": min(max(score, 0), 1),
-                "confidence": 0.75
-            })
-        
-        return {"results": results}
+        await log_request("sentiment", request)
+        return {"results": [score_review(review) for review in request.reviews]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -0,0 +1,69 @@
+"""
+Versioned model artifacts shared by the training pipeline and the API.
+
+Each model lives under ``<MODEL_DIR>/<name>/`` as ``<version>.json`` files plus a
+``LATEST`` pointer. Artifacts and the pointer are written to a temporary file and
+moved into place with ``os.replace``, so a reader never sees a partial write.
+"""
+import json
+import os
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+MODEL_DIR = os.getenv("MODEL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models"))
+MODEL_NAMES = ("recommendations", "demand", "pricing", "eta")
+KEEP_VERSIONS = 5
+
+
+def atomic_write_text(path, text: str):
+    """Write text to path via a temporary file in the same directory."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def save_artifact(name: str, payload: dict, model_dir=None) -> str:
+    """Publish a new version of a model and point LATEST at it. Returns the version."""
+    root = Path(model_dir or MODEL_DIR) / name
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    artifact = {"name": name, "version": version, "model": payload}
+    atomic_write_text(root / f"{version}.json", json.dumps(artifact, default=str))
+    atomic_write_text(root / "LATEST", version)
+
+    versions = sorted(p for p in root.glob("*.json"))
+    for old in versions[:-KEEP_VERSIONS]:
+        old.unlink()
+    return version
+
+
+def load_latest(name: str, model_dir=None) -> Optional[dict]:
+    """Load the latest published artifact for a model, or None if there is none."""
+    root = Path(model_dir or MODEL_DIR) / name
+    try:
+        version = (root / "LATEST").read_text().strip()
+        with open(root / f"{version}.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_models(model_dir=None) -> dict:
+    """Load the latest artifact of every known model that has been trained."""
+    models = {}
+    for name in MODEL_NAMES:
+        artifact = load_latest(name, model_dir)
+        if artifact is not None:
+            models[name] = artifact
+    return models
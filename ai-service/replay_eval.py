@@ -0,0 +1,461 @@
+"""
+Replay-based offline evaluation of the AI service scoring logic.
+
+Replays logged requests (see ``request_log.py``) against one or more candidate
+scorers in parallel worker processes and reports, side by side:
+
+* recommendations: NDCG@k and recall@k against the restaurants each user went on
+  to order from (``place_order`` events in ``user_analytics``) within a horizon
+* chat: intent accuracy on labelled records and agreement with the first candidate
+* sentiment: accuracy on labelled reviews and agreement with the first candidate
+* latency percentiles per endpoint
+
+::
+
+    python replay_eval.py logs/requests-*.jsonl --history-dir data/history \\
+        --candidate current=replay_eval:CurrentScorer --candidate v2=my_scorers:V2Scorer
+
+A candidate is ``name=module:attr``. ``attr`` is called once per worker with the
+cold-start table (built once by the parent and shared by all workers, or None)
+and may implement ``recommend(request, now, has_history) -> [restaurant ids]``,
+``classify_intent(message) -> intent`` and ``sentiment(review) -> label``;
+endpoints a candidate does not implement are skipped for it. ``now`` is the
+logged request time converted with ``cold_start.local_time``, the same
+restaurant-local clock live requests use, so time-of-day and opening-hours logic
+sees the moment the request was served. ``has_history``
+says whether the user had placed an order before that time, or is None when no
+order history was loaded; orders placed after the request are the ground truth
+and must not decide whether the user counts as new.
+
+Log files are split into byte ranges so all workers read a large file at once,
+and each worker returns fixed-size aggregates (sums and latency histograms)
+rather than per-request results, so the parent's work does not grow with the
+number of requests. Ground-truth orders are taken from the events partitions
+exported by ``training_pipeline.py``.
+"""
+import argparse
+import importlib
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from cold_start import load_cold_start_table, local_time
+from model_store import load_models
+from training_pipeline import CHUNK_ROWS, HISTORY_DIR, NO_RESTAURANT, iter_partition_batches, parse_partition_key
+
+ENDPOINTS = ("recommendations", "chat", "sentiment")
+DEFAULT_CANDIDATE = "current=replay_eval:CurrentScorer"
+DEFAULT_K = 10
+DEFAULT_HORIZON_HOURS = 24
+SHARD_BYTES = 32 * 1024 * 1024
+
+# Latency histogram: log-spaced bins from 1 microsecond up to 100 seconds
+LATENCY_MIN_NS = 1_000
+BINS_PER_DECADE = 50
+LATENCY_BINS = 8 * BINS_PER_DECADE
+
+SUMMED_FIELDS = (
+    "requests", "errors", "latency_ns_sum", "judged", "ndcg_sum", "recall_sum",
+    "labelled", "correct", "compared", "agree",
+)
+
+
+class CurrentScorer:
+    """
+    The scoring logic currently in ``main.py``.
+
+    Worker processes never run the service's background tasks, so the cold-start
+    table is the one ``run_replay`` built and passed in.
+    """
+
+    def __init__(self, table=None):
+        import main
+        self._main = main
+        self.table = table
+
+    def recommend(self, request: dict, now: datetime = None, has_history: bool = None) -> list:
+        result = self._main.recommend_restaurants(
+            self._main.RecommendationRequest(**request), self.table, now, has_history
+        )
+        return [restaurant["id"] for restaurant in result["restaurants"]]
+
+    def classify_intent(self, message: str) -> str:
+        return self._main.classify_intent(message)[1]
+
+    def sentiment(self, review: str) -> str:
+        return self._main.score_review(review)["sentiment"]
+
+
+def parse_candidate(spec: str):
+    """Split ``name=module:attr`` into (name, "module:attr")."""
+    name, _, target = spec.rpartition("=")
+    return (name or target), target
+
+
+def resolve_candidate(target: str):
+    module_name, _, attr = target.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class OrderIndex:
+    """``place_order`` events sorted by (user, time) for subsequent-order lookups."""
+
+    def __init__(self, users: np.ndarray, times: np.ndarray, restaurants: np.ndarray, vocabulary: list):
+        self.users = users
+        self.times = times
+        self.restaurants = restaurants
+        self.codes = {restaurant_id: code for code, restaurant_id in enumerate(vocabulary)}
+
+    @classmethod
+    def from_history(cls, history_dir=HISTORY_DIR, batch_rows: int = CHUNK_ROWS) -> "OrderIndex":
+        users, times, restaurants, vocabulary = [], [], [], {}
+        for partition in sorted(Path(history_dir, "events").glob("restaurant_id=*/date=*")):
+            if partition.name.endswith((".staging", ".old")):
+                continue
+            restaurant_id, _ = parse_partition_key(f"{partition.parent.name}/{partition.name}")
+            if restaurant_id == NO_RESTAURANT:
+                continue
+            code = vocabulary.setdefault(restaurant_id, len(vocabulary))
+            for df in iter_partition_batches(partition, ["user_id", "event_type", "timestamp"], batch_rows):
+                orders = df[df["event_type"] == "place_order"].dropna(subset=["user_id", "timestamp"])
+                timestamps = pd.to_datetime(orders["timestamp"], utc=True).dt.tz_localize(None)
+                users.append(orders["user_id"].to_numpy(dtype=np.int64))
+                times.append(timestamps.to_numpy(dtype="datetime64[s]").astype(np.int64))
+                restaurants.append(np.full(len(orders), code, dtype=np.int32))
+
+        if not users:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(empty, empty, np.zeros(0, dtype=np.int32), [])
+        users, times, restaurants = np.concatenate(users), np.concatenate(times), np.concatenate(restaurants)
+        order = np.lexsort((times, users))
+        return cls(users[order], times[order], restaurants[order], list(vocabulary))
+
+    def ordered_before(self, user_id, before: int) -> bool:
+        """True if the user placed an order at or before ``before``."""
+        if user_id is None or not len(self.users):
+            return False
+        lo = np.searchsorted(self.users, user_id, side="left")
+        return bool(lo < len(self.users) and self.users[lo] == user_id and self.times[lo] <= before)
+
+    def relevant(self, user_id, after: int, horizon_seconds: int) -> set:
+        """Restaurant codes the user ordered from within the horizon after ``after``."""
+        if user_id is None or not len(self.users):
+            return set()
+        lo = np.searchsorted(self.users, user_id, side="left")
+        hi = np.searchsorted(self.users, user_id, side="right")
+        if lo == hi:
+            return set()
+        user_times = self.times[lo:hi]
+        start = lo + np.searchsorted(user_times, after, side="right")
+        stop = lo + np.searchsorted(user_times, after + horizon_seconds, side="right")
+        return set(self.restaurants[start:stop].tolist())
+
+
+def ranking_metrics(ranked_codes: list, relevant: set, k: int):
+    """NDCG@k and recall@k of a ranked list against a set of relevant codes."""
+    hits = [rank for rank, code in enumerate(ranked_codes[:k]) if code in relevant]
+    dcg = sum(1 / math.log2(rank + 2) for rank in hits)
+    idcg = sum(1 / math.log2(rank + 2) for rank in range(min(len(relevant), k)))
+    return dcg / idcg, len(set(ranked_codes[:k]) & relevant) / len(relevant)
+
+
+def sentiment_label(label):
+    """Normalise a review label: star ratings map to positive/neutral/negative."""
+    if isinstance(label, (int, float)) and not isinstance(label, bool):
+        return "positive" if label >= 4 else "negative" if label <= 2 else "neutral"
+    return label
+
+
+def new_stats() -> dict:
+    stats = dict.fromkeys(SUMMED_FIELDS, 0)
+    stats["latency_ns_max"] = 0
+    stats["latency_hist"] = [0] * LATENCY_BINS
+    return stats
+
+
+def merge_stats(into: dict, other: dict):
+    for field in SUMMED_FIELDS:
+        into[field] += other[field]
+    into["latency_ns_max"] = max(into["latency_ns_max"], other["latency_ns_max"])
+    into["latency_hist"] = [a + b for a, b in zip(into["latency_hist"], other["latency_hist"])]
+
+
+def _latency_bin(elapsed_ns: int) -> int:
+    if elapsed_ns <= LATENCY_MIN_NS:
+        return 0
+    return min(int(math.log10(elapsed_ns / LATENCY_MIN_NS) * BINS_PER_DECADE), LATENCY_BINS - 1)
+
+
+def _timed(stats: dict, fn, *args):
+    """Call fn, recording its latency; returns None if it raised."""
+    started = time.perf_counter_ns()
+    try:
+        return fn(*args)
+    except Exception:
+        stats["errors"] += 1
+        return None
+    finally:
+        elapsed = time.perf_counter_ns() - started
+        stats["requests"] += 1
+        stats["latency_ns_sum"] += elapsed
+        stats["latency_ns_max"] = max(stats["latency_ns_max"], elapsed)
+        stats["latency_hist"][_latency_bin(elapsed)] += 1
+
+
+def _record_time(ts: str) -> int:
+    moment = datetime.fromisoformat(ts)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def _record_datetime(ts: str) -> datetime:
+    """The logged request time on the restaurant-local clock used by live lookups."""
+    return local_time(datetime.fromisoformat(ts))
+
+
+_worker = {}
+
+
+def _init_worker(candidates, orders, cold_start_table, k, horizon_seconds):
+    _worker["candidates"] = [(name, resolve_candidate(target)(cold_start_table)) for name, target in candidates]
+    _worker["orders"] = orders
+    _worker["k"] = k
+    _worker["horizon"] = horizon_seconds
+
+
+def _replay_record(record: dict, stats: dict):
+    candidates, orders, k = _worker["candidates"], _worker["orders"], _worker["k"]
+    endpoint = record.get("endpoint")
+    request = record.get("request") or {}
+
+    if endpoint == "recommendations":
+        relevant, now, has_history = set(), None, None
+        if record.get("ts"):
+            now = _record_datetime(record["ts"])
+            if orders is not None:
+                at = _record_time(record["ts"])
+                relevant = orders.relevant(request.get("user_id"), at, _worker["horizon"])
+                has_history = orders.ordered_before(request.get("user_id"), at)
+        for name, scorer in candidates:
+            if not hasattr(scorer, "recommend"):
+                continue
+            s = stats[name][endpoint]
+            ranking = _timed(s, scorer.recommend, request, now, has_history)
+            if ranking is not None and relevant:
+                codes = [orders.codes.get(str(restaurant_id), -1) for restaurant_id in ranking]
+                ndcg, recall = ranking_metrics(codes, relevant, k)
+                s["judged"] += 1
+                s["ndcg_sum"] += ndcg
+                s["recall_sum"] += recall
+
+    elif endpoint == "chat":
+        label = record.get("label")
+        reference = None
+        for position, (name, scorer) in enumerate(candidates):
+            if not hasattr(scorer, "classify_intent"):
+                continue
+            s = stats[name][endpoint]
+            intent = _timed(s, scorer.classify_intent, request.get("message", ""))
+            if intent is None:
+                continue
+            if label is not None:
+                s["labelled"] += 1
+                s["correct"] += intent == label
+            if position == 0:
+                reference = intent
+            elif reference is not None:
+                s["compared"] += 1
+                s["agree"] += intent == reference
+
+    elif endpoint == "sentiment":
+        reviews = request.get("reviews") or []
+        labels = record.get("label") or []
+        reference = None
+        for position, (name, scorer) in enumerate(candidates):
+            if not hasattr(scorer, "sentiment"):
+                continue
+            s = stats[name][endpoint]
+            predicted = _timed(s, lambda: [scorer.sentiment(review) for review in reviews])
+            if predicted is None:
+                continue
+            for prediction, label in zip(predicted, labels):
+                if label is not None:
+                    s["labelled"] += 1
+                    s["correct"] += prediction == sentiment_label(label)
+            if position == 0:
+                reference = predicted
+            elif reference is not None:
+                s["compared"] += len(predicted)
+                s["agree"] += sum(a == b for a, b in zip(predicted, reference))
+
+
+def replay_shard(path: str, start: int, end: int) -> dict:
+    """Replay the records whose lines start within [start, end) of a JSONL file."""
+    stats = {name: {endpoint: new_stats() for endpoint in ENDPOINTS} for name, _ in _worker["candidates"]}
+    with open(path, "rb") as f:
+        if start:
+            # Skip the line that straddles the shard boundary; the previous shard owns it
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            _replay_record(record, stats)
+    return stats
+
+
+def _replay_shard_task(shard):
+    return replay_shard(*shard)
+
+
+def plan_shards(paths, shard_bytes: int = SHARD_BYTES) -> list:
+    """Split log files into (path, start, end) byte ranges."""
+    shards = []
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, size, shard_bytes):
+            shards.append((str(path), start, min(start + shard_bytes, size)))
+    return shards
+
+
+def latency_percentile(stats: dict, quantile: float) -> float:
+    """Upper edge (in ms) of the histogram bin holding the given quantile."""
+    target = quantile * stats["requests"]
+    cumulative = 0
+    for index, count in enumerate(stats["latency_hist"]):
+        cumulative += count
+        if count and cumulative >= target:
+            upper_ns = LATENCY_MIN_NS * 10 ** ((index + 1) / BINS_PER_DECADE)
+            return round(min(upper_ns, stats["latency_ns_max"]) / 1e6, 4)
+    return 0.0
+
+
+def summarize(totals: dict, k: int) -> dict:
+    report = {}
+    for name, endpoints in totals.items():
+        report[name] = {}
+        for endpoint, s in endpoints.items():
+            if not s["requests"]:
+                continue
+            summary = {
+                "requests": s["requests"],
+                "errors": s["errors"],
+                "latency_ms": {
+                    "mean": round(s["latency_ns_sum"] / s["requests"] / 1e6, 4),
+                    "p50": latency_percentile(s, 0.5),
+                    "p90": latency_percentile(s, 0.9),
+                    "p99": latency_percentile(s, 0.99),
+                    "max": round(s["latency_ns_max"] / 1e6, 4),
+                },
+            }
+            if endpoint == "recommendations":
+                summary["judged"] = s["judged"]
+                summary[f"ndcg@{k}"] = round(s["ndcg_sum"] / s["judged"], 4) if s["judged"] else None
+                summary[f"recall@{k}"] = round(s["recall_sum"] / s["judged"], 4) if s["judged"] else None
+            else:
+                summary["labelled"] = s["labelled"]
+                summary["accuracy"] = round(s["correct"] / s["labelled"], 4) if s["labelled"] else None
+                summary["agreement"] = round(s["agree"] / s["compared"], 4) if s["compared"] else None
+            report[name][endpoint] = summary
+    return report
+
+
+def run_replay(paths, candidates=(DEFAULT_CANDIDATE,), history_dir=HISTORY_DIR, workers: int = None,
+               k: int = DEFAULT_K, horizon_hours: float = DEFAULT_HORIZON_HOURS,
+               shard_bytes: int = SHARD_BYTES, cold_start_table=None) -> dict:
+    """
+    Replay log files against every candidate and return the summarized report.
+
+    Without ``cold_start_table`` the table is built here from the databases and
+    trained models, once, so every worker scores against the same snapshot.
+    """
+    candidates = [parse_candidate(spec) for spec in candidates]
+    for _, target in candidates:
+        # Fail fast on typos instead of inside every worker
+        resolve_candidate(target)
+    orders = OrderIndex.from_history(history_dir) if history_dir else None
+    if cold_start_table is None:
+        cold_start_table = load_cold_start_table(load_models())
+
+    totals = {name: {endpoint: new_stats() for endpoint in ENDPOINTS} for name, _ in candidates}
+    shards = plan_shards(paths, shard_bytes)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                             initargs=(candidates, orders, cold_start_table, k, int(horizon_hours * 3600))) as pool:
+        for shard_stats in pool.map(_replay_shard_task, shards):
+            for name, endpoints in shard_stats.items():
+                for endpoint, s in endpoints.items():
+                    merge_stats(totals[name][endpoint], s)
+    return summarize(totals, k)
+
+
+def format_report(report: dict) -> str:
+    """Render the report as a table with one column per candidate."""
+    names = list(report)
+    rows = []
+    for endpoint in ENDPOINTS:
+        metrics = []
+        for name in names:
+            for metric, value in report[name].get(endpoint, {}).items():
+                if metric == "latency_ms":
+                    metrics.extend(f"latency_{p}_ms" for p in value if f"latency_{p}_ms" not in metrics)
+                elif metric not in metrics:
+                    metrics.append(metric)
+        for metric in metrics:
+            values = []
+            for name in names:
+                summary = report[name].get(endpoint, {})
+                if metric.startswith("latency_"):
+                    value = summary.get("latency_ms", {}).get(metric[len("latency_"):-len("_ms")])
+                else:
+                    value = summary.get(metric)
+                values.append("-" if value is None else str(value))
+            rows.append((f"{endpoint} {metric}", values))
+
+    label_width = max([len(label) for label, _ in rows] + [6])
+    widths = [max([len(name)] + [len(values[i]) for _, values in rows]) for i, name in enumerate(names)]
+    lines = ["  ".join(["metric".ljust(label_width)] + [name.rjust(w) for name, w in zip(names, widths)])]
+    for label, values in rows:
+        lines.append("  ".join([label.ljust(label_width)] + [v.rjust(w) for v, w in zip(values, widths)]))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay logged requests against candidate scorers")
+    parser.add_argument("logs", nargs="+", help="JSONL request logs written by request_log.py")
+    parser.add_argument("--candidate", action="append", dest="candidates",
+                        help=f"name=module:attr (repeatable, default: {DEFAULT_CANDIDATE})")
+    parser.add_argument("--history-dir", default=HISTORY_DIR, help="exported history with events partitions")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--k", type=int, default=DEFAULT_K)
+    parser.add_argument("--horizon-hours", type=float, default=DEFAULT_HORIZON_HOURS,
+                        help="how long after a request a place_order event still counts as relevant")
+    parser.add_argument("--shard-mb", type=int, default=SHARD_BYTES // (1024 * 1024))
+    parser.add_argument("--output", help="also write the report as JSON to this path")
+    args = parser.parse_args(argv)
+
+    report = run_replay(args.logs, args.candidates or [DEFAULT_CANDIDATE], args.history_dir, args.workers,
+                        args.k, args.horizon_hours, args.shard_mb * 1024 * 1024)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Append-only request log for offline replay.
+
+When REQUEST_LOG_DIR is set, ``main.py`` records the bodies of recommendation,
+chat and sentiment requests as JSON lines in ``requests-YYYY-MM-DD.jsonl``::
+
+    {"ts": "2024-01-01T19:30:00.123456", "endpoint": "chat", "request": {...}}
+
+Lines are buffered and appended in batches. ``replay_eval.py`` reads these files;
+an optional ``"label"`` field (true intent, review sentiment) can be added to
+records afterwards for accuracy metrics.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class RequestLogger:
+    """Buffer logged requests and append them to a daily JSONL file."""
+
+    def __init__(self, log_dir=None, batch_size: int = 1000, flush_interval_seconds: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.log_dir = Path(log_dir) if log_dir else None
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self._clock = clock
+        self._buffer = []
+        self._last_flush = clock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, **kwargs) -> "RequestLogger":
+        return cls(os.getenv("REQUEST_LOG_DIR"), **kwargs)
+
+    def log(self, endpoint: str, request: dict) -> bool:
+        """Queue a request; returns True when a flush is due."""
+        if self.log_dir is None:
+            return False
+        record = {"ts": datetime.now(timezone.utc).replace(tzinfo=None).isoformat(), "endpoint": endpoint, "request": request}
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._buffer.append(line)
+            return (
+                len(self._buffer) >= self.batch_size
+                or self._clock() - self._last_flush >= self.flush_interval_seconds
+            )
+
+    def flush(self) -> int:
+        """Append all buffered lines to today's file; returns how many were written."""
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+            self._last_flush = self._clock()
+        if not lines or self.log_dir is None:
+            return 0
+        path = self.log_dir / f"requests-{datetime.now(timezone.utc):%Y-%m-%d}.jsonl"
+        try:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            with open(path, "a") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError:
+            logger.exception("Failed to write %d request log lines", len(lines))
+            return 0
+        return len(lines)
@@ -0,0 +1,282 @@
+import pytest
+import time
+from datetime import datetime
+from fastapi.testclient import TestClient
+
+import chat_sessions
+import main
+from chat_sessions import (
+    ChatHistoryWriter, ChatSession, ChatSessionStore, OrderLookupError, PostgresOrderLoader, extract_order_number
+)
+
+client = TestClient(main.app)
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class FakeCollection:
+    def __init__(self):
+        self.batches = []
+
+    def insert_many(self, documents, ordered=True):
+        self.batches.append(list(documents))
+
+class CountingOrderLoader:
+    def __init__(self, orders):
+        self.orders = orders
+        self.calls = 0
+
+    def __call__(self, order_number):
+        self.calls += 1
+        if self.orders is None:
+            raise OrderLookupError("could not connect to server")
+        return self.orders.get(order_number)
+
+def refuse_connection():
+    raise ConnectionError("could not connect to server")
+
+class TestChatSessionStore:
+    """Test session bookkeeping and eviction."""
+
+    def test_session_key(self):
+        assert ChatSessionStore.session_key(None) is None
+        assert ChatSessionStore.session_key({}) is None
+        assert ChatSessionStore.session_key({"user_id": 7}) == "user:7"
+        assert ChatSessionStore.session_key({"session_id": "abc", "user_id": 7}) == "session:abc"
+
+    def test_lru_cap(self):
+        store = ChatSessionStore(max_sessions=2)
+        store.get_or_create("a")
+        store.get_or_create("b")
+        store.get_or_create("a")
+        store.get_or_create("c")
+        assert len(store) == 2
+        assert store.get("b") is None
+        assert store.get("a") is not None
+
+    def test_idle_eviction(self):
+        clock = FakeClock()
+        store = ChatSessionStore(idle_ttl_seconds=60, clock=clock)
+        store.get_or_create("a")
+        clock.now = 30
+        store.get_or_create("b")
+        clock.now = 70
+        store.get_or_create("c")
+        assert store.get("a") is None
+        assert store.get("b") is not None
+
+    def test_turn_ring_buffer(self):
+        store = ChatSessionStore(max_turns=3)
+        session = store.get_or_create("a")
+        for i in range(5):
+            session.add_turn("customer", f"message {i}")
+        assert [t[1] for t in session.turns] == ["message 2", "message 3", "message 4"]
+
+    def test_extract_order_number(self):
+        assert extract_order_number("Where is order #12345?") == "12345"
+        assert extract_order_number("my order number is ORD-1001") == "ORD-1001"
+        assert extract_order_number("12345") == "12345"
+        assert extract_order_number("What is my order status?") is None
+        assert extract_order_number("ready in 30 minutes") is None
+
+    def test_extract_ignores_incidental_numbers(self):
+        assert extract_order_number("my order is 150 minutes late, where is it?") is None
+        assert extract_order_number("I ordered 2 pizzas at 7:30pm") is None
+        assert extract_order_number("order no. 5566") == "5566"
+        assert extract_order_number("12345", allow_bare=False) is None
+
+class TestPostgresOrderLoader:
+    """Test order lookups against an unavailable database."""
+
+    def test_connection_error_is_a_lookup_failure(self, monkeypatch):
+        monkeypatch.setattr(chat_sessions.db, "get_postgres_connection", refuse_connection)
+        with pytest.raises(OrderLookupError):
+            PostgresOrderLoader()("12345")
+
+    def test_unconfigured_database_is_a_lookup_failure(self, monkeypatch):
+        monkeypatch.setattr(chat_sessions.db, "get_postgres_connection", lambda: None)
+        with pytest.raises(OrderLookupError):
+            PostgresOrderLoader()("12345")
+
+class TestChatHistoryWriter:
+    """Test batched persistence of chat history."""
+
+    def test_turns_wait_for_resolved_order(self):
+        collection = FakeCollection()
+        writer = ChatHistoryWriter(collection=collection, batch_size=3)
+        session = ChatSession("user:1", user_id=1)
+
+        assert writer.record_turn(session, "customer", "What is my order status?") is False
+        assert writer.record_turn(session, "support", "Please provide your order number.") is False
+        assert writer.pending() == 0
+
+        session.order_state = {"id": "9b2c-uuid", "status": "preparing"}
+        assert writer.record_turn(session, "customer", "ORD-1001") is True
+        assert len(session.pending_history) == 0
+
+        assert writer.flush() == 3
+        assert len(collection.batches) == 1
+        assert [d["message"] for d in collection.batches[0]] == [
+            "What is my order status?", "Please provide your order number.", "ORD-1001"
+        ]
+        assert collection.batches[0][0]["order_id"] == "9b2c-uuid"
+        assert collection.batches[0][0]["sender_id"] == 1
+        assert writer.pending() == 0
+
+    def test_skipped_turns_are_counted(self):
+        writer = ChatHistoryWriter(collection=FakeCollection())
+        anonymous = ChatSession("session:x")
+        writer.record_turn(anonymous, "customer", "hi")
+        anonymous.order_state = {"id": "o1"}
+        writer.record_turn(anonymous, "customer", "#12345")
+        assert writer.skipped == 2
+
+        unresolved = ChatSession("user:2", user_id=2)
+        writer.record_turn(unresolved, "customer", "hello")
+        writer.discard_session(unresolved)
+        assert writer.skipped == 3
+        assert writer.pending() == 0
+
+    def test_evicted_sessions_are_discarded(self):
+        writer = ChatHistoryWriter(collection=FakeCollection())
+        store = ChatSessionStore(max_sessions=1, on_evict=writer.discard_session)
+        writer.record_turn(store.get_or_create("a", user_id=1), "customer", "hello")
+        store.get_or_create("b")
+        assert writer.skipped == 1
+
+    def test_disabled_without_collection(self):
+        writer = ChatHistoryWriter(collection=None)
+        session = ChatSession("user:1", user_id=1)
+        session.order_state = {"id": "o1"}
+        assert writer.record_turn(session, "customer", "hi") is False
+        assert writer.flush() == 0
+
+class TestStatefulChatSupport:
+    """Test follow-up turns reuse session state."""
+
+    @pytest.fixture(autouse=True)
+    def isolated_state(self, monkeypatch):
+        loader = CountingOrderLoader({
+            "12345": {
+                "id": "5f0e7c1a-order-uuid",
+                "order_number": "12345",
+                "status": "on_the_way",
+                "estimated_delivery_time": datetime(2024, 1, 1, 18, 45),
+                "actual_delivery_time": None,
+            }
+        })
+        monkeypatch.setattr(main, "chat_sessions", ChatSessionStore())
+        monkeypatch.setattr(main, "order_loader", loader)
+        monkeypatch.setattr(main, "chat_history_writer", ChatHistoryWriter(collection=None))
+        return loader
+
+    def test_follow_up_turns_use_prefetched_order(self, isolated_state):
+        context = {"session_id": "s1", "user_id": 123}
+
+        data = client.post("/chat/support", json={"message": "What is my order status?", "context": context}).json()
+        assert data["intent"] == "order_status"
+        assert "provide your order number" in data["response"]
+
+        data = client.post("/chat/support", json={"message": "12345", "context": context}).json()
+        assert data["intent"] == "order_status"
+        assert "on the way" in data["response"]
+        assert isolated_state.calls == 1
+
+        data = client.post("/chat/support", json={"message": "How long until delivery?", "context": context}).json()
+        assert data["intent"] == "delivery_inquiry"
+        assert "18:45" in data["response"]
+        assert isolated_state.calls == 1
+
+    def test_incidental_numbers_keep_resolved_order(self, isolated_state):
+        context = {"session_id": "s2", "user_id": 123}
+
+        data = client.post("/chat/support", json={"message": "track order #12345", "context": context}).json()
+        assert "on the way" in data["response"]
+
+        for text in ["my order is 150 minutes late, where is it?", "I ordered 2 pizzas at 7:30pm",
+                     "what's the status?", "999"]:
+            data = client.post("/chat/support", json={"message": text, "context": context}).json()
+            assert "couldn't find" not in data["response"]
+        assert main.chat_sessions.get("session:s2").order_number == "12345"
+        assert isolated_state.calls == 1
+
+    def test_unknown_order_is_looked_up_once(self, isolated_state):
+        context = {"user_id": 5}
+        for _ in range(2):
+            data = client.post("/chat/support", json={"message": "track order #99999", "context": context}).json()
+            assert "couldn't find order #99999" in data["response"]
+        assert isolated_state.calls == 1
+
+    def test_lookup_failure_is_not_cached(self, isolated_state):
+        context = {"session_id": "s5", "user_id": 123}
+        orders, isolated_state.orders = isolated_state.orders, None
+
+        response = client.post("/chat/support", json={"message": "track order #12345", "context": context})
+        assert response.status_code == 200
+        assert "can't check order #12345 right now" in response.json()["response"]
+
+        isolated_state.orders = orders
+        data = client.post("/chat/support", json={"message": "order status?", "context": context}).json()
+        assert "on the way" in data["response"]
+        assert isolated_state.calls == 2
+
+    def test_history_written_once_order_resolves(self, isolated_state, monkeypatch):
+        collection = FakeCollection()
+        monkeypatch.setattr(main, "chat_history_writer", ChatHistoryWriter(collection=collection, batch_size=1))
+        context = {"session_id": "s3", "user_id": 123}
+
+        client.post("/chat/support", json={"message": "What is my order status?", "context": context})
+        assert collection.batches == []
+        client.post("/chat/support", json={"message": "12345", "context": context})
+
+        documents = [d for batch in collection.batches for d in batch]
+        assert len(documents) == 4
+        assert {d["order_id"] for d in documents} == {"5f0e7c1a-order-uuid"}
+        assert [d["sender_type"] for d in documents] == ["customer", "support", "customer", "support"]
+
+    def test_order_state_refetched_after_ttl(self, isolated_state, monkeypatch):
+        clock = FakeClock()
+        monkeypatch.setattr(main, "chat_sessions", ChatSessionStore(order_state_ttl_seconds=60, clock=clock))
+        context = {"session_id": "s4", "user_id": 123}
+
+        def ask():
+            return client.post("/chat/support", json={"message": "order status?", "context": context}).json()
+
+        client.post("/chat/support", json={"message": "track order #12345", "context": context})
+        clock.now = 30
+        assert "on the way" in ask()["response"]
+        assert isolated_state.calls == 1
+
+        isolated_state.orders["12345"] = dict(isolated_state.orders["12345"], status="delivered")
+        clock.now = 61
+        assert "delivered" in ask()["response"]
+        assert isolated_state.calls == 2
+
+        # Final statuses are not refetched
+        clock.now = 1000
+        assert "delivered" in ask()["response"]
+        assert isolated_state.calls == 2
+
+    def test_partial_batch_flushed_periodically(self, isolated_state, monkeypatch):
+        collection = FakeCollection()
+        writer = ChatHistoryWriter(collection=collection, batch_size=100, flush_interval_seconds=0.01)
+        monkeypatch.setattr(main, "chat_history_writer", writer)
+
+        with TestClient(main.app) as lifespan_client:
+            lifespan_client.post("/chat/support", json={
+                "message": "track order #12345", "context": {"user_id": 1}
+            })
+            deadline = time.monotonic() + 2
+            while not collection.batches and time.monotonic() < deadline:
+                time.sleep(0.01)
+        assert len(collection.batches[0]) == 2
+
+    def test_stateless_without_context(self, isolated_state):
+        data = client.post("/chat/support", json={"message": "where is order #12345"}).json()
+        assert data["intent"] == "order_status"
+        assert isolated_state.calls == 0
+        assert len(main.chat_sessions) == 0
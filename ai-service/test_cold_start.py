@@ -0,0 +1,164 @@
+import pytest
+from datetime import datetime
+from fastapi.testclient import TestClient
+
+import cold_start
+import main
+from cold_start import ColdStartTable, dietary_filter, geo_cell, parse_operating_hours, time_bucket
+
+client = TestClient(main.app)
+
+# A Monday evening
+NOW = datetime(2024, 1, 1, 19, 30)
+NYC = {"lat": 40.7128, "lng": -74.0060}
+
+def restaurant(restaurant_id, rating, lat=40.7130, lng=-74.0050, is_open=True, operating_hours=None, **dietary):
+    return {
+        "id": restaurant_id, "name": f"Restaurant {restaurant_id}", "cuisine_type": ["Italian"],
+        "rating": rating, "address": {"lat": lat, "lng": lng}, "delivery_time_min": 20,
+        "delivery_time_max": 40, "is_open": is_open, "operating_hours": operating_hours,
+        "has_vegetarian": dietary.get("vegetarian", False), "has_vegan": dietary.get("vegan", False),
+        "has_gluten_free": dietary.get("gluten_free", False),
+    }
+
+@pytest.fixture
+def table():
+    rows = [
+        restaurant("a", 4.0, vegetarian=True),
+        restaurant("b", 4.8),
+        restaurant("c", 3.5, vegetarian=True, vegan=True),
+        restaurant("closed", 5.0, is_open=False),
+        restaurant("lunch-only", 4.9, operating_hours={"monday": {"open": "11:00", "close": "15:00"}}),
+        restaurant("far", 5.0, lat=34.05, lng=-118.24),
+    ]
+    hourly = [0.0] * 24
+    hourly[19] = 40.0
+    models = {"demand": {"version": "v1", "model": {"c": {"hourly_orders": hourly, "days": 10}}}}
+    return ColdStartTable.build(rows, models, known_users=[7, 3, 7])
+
+class TestColdStartTable:
+    """Test precomputed cold-start rankings."""
+
+    def test_ranked_by_rating_and_time_of_day_demand(self, table):
+        names = [r["id"] for r in table.lookup(NYC, "dinner", None, now=NOW)]
+        # "c" has the most dinner demand, lifting it above "a" but not by more than
+        # one star, so it stays below "b"; "closed", "lunch-only" and "far" are filtered out
+        assert names == ["b", "c", "a"]
+
+        names = [r["id"] for r in table.lookup(NYC, "breakfast", None, now=NOW)]
+        assert names == ["b", "a", "c"]
+
+    def test_dietary_filter(self, table):
+        vegan = table.lookup(NYC, "dinner", {"dietary": ["vegan"]}, now=NOW)
+        assert [r["id"] for r in vegan] == ["c"]
+        gluten_free = table.lookup(NYC, "dinner", {"dietary": ["gluten-free"]}, now=NOW)
+        assert gluten_free == []
+
+    def test_operating_hours(self, table):
+        lunch = datetime(2024, 1, 1, 12, 0)
+        assert "lunch-only" in [r["id"] for r in table.lookup(NYC, "lunch", None, now=lunch)]
+
+    def test_uncovered_cell(self, table):
+        assert table.lookup({"lat": 0.0, "lng": 0.0}, "dinner", None, now=NOW) is None
+
+    def test_availability_refresh(self, table):
+        table.update_availability([{"id": "b", "is_open": False}])
+        assert "b" not in [r["id"] for r in table.lookup(NYC, "dinner", None, now=NOW)]
+
+    def test_known_users(self, table):
+        assert table.has_history(7)
+        assert table.has_history(3)
+        assert not table.has_history(5)
+
+    def test_helpers(self):
+        assert time_bucket("evening", NOW) == "dinner"
+        assert time_bucket(None, datetime(2024, 1, 1, 8)) == "breakfast"
+        assert time_bucket(None, datetime(2024, 1, 1, 23)) == "late_night"
+        assert dietary_filter({"dietary": ["vegetarian", "vegan"]}) == "vegan"
+        assert dietary_filter(None) == "any"
+        assert dietary_filter({"dietary": [None, 5, "vegan"]}) == "vegan"
+        assert dietary_filter({"dietary": True}) == "any"
+        assert geo_cell({"lat": "abc", "lng": 1}) is None
+        assert geo_cell({"lat": None, "lng": 1}) is None
+        assert geo_cell({"lat": "40.7128", "lng": -74.006}) == geo_cell(NYC)
+        hours = parse_operating_hours({"Mon": "22:00-02:00", "tuesday": "closed", "wednesday": {"open": "x"}})
+        assert hours[0].tolist() == [1320, 120]
+        assert hours[1].tolist() == [-2, -2]
+        assert hours[2].tolist() == [-1, -1]
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return FakeCursor(self.rows)
+
+    def close(self):
+        pass
+
+class FakeAnalytics:
+    def aggregate(self, pipeline, **kwargs):
+        return iter([{"_id": 7}, {"_id": 3}])
+
+class TestLoadColdStartTable:
+    """Test building the table from the databases."""
+
+    def test_no_table_without_order_history_source(self, monkeypatch):
+        monkeypatch.setattr(cold_start.db, "get_postgres_connection", lambda: FakeConnection([restaurant("a", 4.0)]))
+        monkeypatch.setattr(cold_start.db, "get_mongo_database", lambda: None)
+        assert cold_start.load_cold_start_table() is None
+
+    def test_builds_with_known_users(self, monkeypatch):
+        monkeypatch.setattr(cold_start.db, "get_postgres_connection", lambda: FakeConnection([restaurant("a", 4.0)]))
+        monkeypatch.setattr(cold_start.db, "get_mongo_database", lambda: {"user_analytics": FakeAnalytics()})
+        table = cold_start.load_cold_start_table()
+        assert table.has_history(7)
+        assert not table.has_history(5)
+
+class TestColdStartEndpoint:
+    """Test /recommendations/restaurants routing between cold-start and personalized paths."""
+
+    def test_new_user_served_from_table(self, table, monkeypatch):
+        monkeypatch.setattr(main, "cold_start_table", table)
+        response = client.post("/recommendations/restaurants", json={
+            "user_id": 5, "location": NYC, "time_of_day": "breakfast"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["restaurants"]
+        assert all(r["reason"].startswith("Popular nearby") for r in data["restaurants"])
+
+    def test_user_with_history_takes_personalized_path(self, table, monkeypatch):
+        monkeypatch.setattr(main, "cold_start_table", table)
+        response = client.post("/recommendations/restaurants", json={
+            "user_id": 7, "location": NYC, "time_of_day": "dinner"
+        })
+        data = response.json()
+        assert data["restaurants"][0]["name"] == "Italian Bistro"
+
+    @pytest.mark.parametrize("payload", [
+        {"user_preferences": {"dietary": [None]}},
+        {"user_preferences": {"dietary": True}},
+        {"location": {"lat": "abc", "lng": 1}},
+    ])
+    def test_malformed_preferences_fall_back(self, table, monkeypatch, payload):
+        monkeypatch.setattr(main, "cold_start_table", table)
+        response = client.post("/recommendations/restaurants", json=dict(payload, user_id=5))
+        assert response.status_code == 200
+        assert response.json()["restaurants"]
@@ -0,0 +1,188 @@
+import json
+import pytest
+from datetime import datetime
+from fastapi.testclient import TestClient
+
+import cold_start
+import main
+import replay_eval
+from cold_start import ColdStartTable
+from request_log import RequestLogger
+from training_pipeline import PartitionWriter, partition_key
+
+client = TestClient(main.app)
+
+def snapshot_table():
+    """
+    Cold-start snapshot taken after the replayed period: every user in the history
+    has ordered by then, so the replay must decide who was new at request time.
+    """
+    rows = [
+        {"id": restaurant_id, "name": f"Restaurant {restaurant_id}", "rating": rating, "is_open": True,
+         "operating_hours": hours}
+        for restaurant_id, rating, hours in [
+            ("7", 5.0, {"monday": "09:00-12:00"}),
+            ("2", 4.5, None),
+            ("5", 4.0, None),
+            ("9", 3.0, None),
+        ]
+    ]
+    return ColdStartTable.build(rows, known_users=[1, 2, 3])
+
+class ReversedScorer:
+    """Candidate that reverses the current recommendations and always answers neutral/general."""
+
+    def __init__(self, table):
+        self.current = replay_eval.CurrentScorer(table)
+
+    def recommend(self, request, now, has_history):
+        return list(reversed(self.current.recommend(request, now, has_history)))
+
+    def classify_intent(self, message):
+        return "general_inquiry"
+
+    def sentiment(self, review):
+        return "neutral"
+
+def place_order(user_id, restaurant_id, timestamp):
+    return {"user_id": user_id, "session_id": "s", "event_type": "place_order",
+            "timestamp": datetime.fromisoformat(timestamp), "restaurant_id": restaurant_id, "metadata": "{}"}
+
+@pytest.fixture
+def history(tmp_path):
+    history_dir = tmp_path / "history"
+    writer = PartitionWriter(history_dir / "events")
+    for event in [
+        place_order(1, "2", "2024-01-01T19:00:00"),
+        place_order(2, "5", "2024-01-01T19:00:00"),
+        # Too late to count for user 2's request
+        place_order(2, "1", "2024-01-03T19:00:00"),
+        # User 3 already had history when their request was logged
+        place_order(3, "9", "2023-12-31T19:00:00"),
+        {"user_id": 1, "session_id": "s", "event_type": "view_restaurant",
+         "timestamp": datetime(2024, 1, 1, 18), "restaurant_id": "1", "metadata": "{}"},
+    ]:
+        writer.add(partition_key(event["restaurant_id"], event["timestamp"]), event)
+    writer.close()
+    return history_dir
+
+@pytest.fixture
+def request_log(tmp_path):
+    records = [
+        {"ts": "2024-01-01T18:00:00", "endpoint": "recommendations", "request": {"user_id": 1}},
+        {"ts": "2024-01-01T18:00:00", "endpoint": "recommendations", "request": {"user_id": 2}},
+        {"ts": "2024-01-01T18:00:00", "endpoint": "recommendations", "request": {"user_id": 3}},
+        {"ts": "2024-01-01T18:05:00", "endpoint": "chat", "request": {"message": "where is my order"},
+         "label": "order_status"},
+        {"ts": "2024-01-01T18:05:00", "endpoint": "chat", "request": {"message": "hello"},
+         "label": "general_inquiry"},
+        {"ts": "2024-01-01T18:05:00", "endpoint": "chat", "request": {"message": "I want a refund"}},
+        {"ts": "2024-01-01T18:10:00", "endpoint": "sentiment",
+         "request": {"reviews": ["Great food!", "Terrible service", "It was fine"]}, "label": [5, 1, 3]},
+    ]
+    path = tmp_path / "requests-2024-01-01.jsonl"
+    path.write_text("\n".join(json.dumps(r) for r in records) + "\nnot json\n")
+    return path
+
+class TestReplayMetrics:
+    """Test metric helpers."""
+
+    def test_ranking_metrics(self):
+        ndcg, recall = replay_eval.ranking_metrics([5, 3], {3}, 10)
+        assert ndcg == pytest.approx(0.6309, abs=1e-4)
+        assert recall == 1.0
+        assert replay_eval.ranking_metrics([5, 3], {3, 4}, 1) == (0.0, 0.0)
+
+    def test_order_index(self, history):
+        orders = replay_eval.OrderIndex.from_history(history)
+        start = replay_eval._record_time("2024-01-01T18:00:00")
+        assert orders.relevant(1, start, 24 * 3600) == {orders.codes["2"]}
+        assert orders.relevant(2, start, 24 * 3600) == {orders.codes["5"]}
+        assert orders.relevant(3, start, 24 * 3600) == set()
+        assert not orders.ordered_before(1, start)
+        assert not orders.ordered_before(2, start)
+        assert orders.ordered_before(3, start)
+        assert not orders.ordered_before(4, start)
+
+    def test_scorer_uses_record_time(self):
+        scorer = replay_eval.CurrentScorer(snapshot_table())
+        morning = replay_eval._record_datetime("2024-01-01T10:00:00+00:00")
+        assert scorer.recommend({"user_id": 1}, morning, False) == ["7", "2", "5", "9"]
+        assert scorer.recommend({"user_id": 1}, datetime(2024, 1, 1, 18), False) == ["2", "5", "9"]
+        # Users with history take the personalized path
+        assert scorer.recommend({"user_id": 1}, morning, True) == [1, 2]
+        assert scorer.recommend({"user_id": 1}, morning) == [1, 2]
+
+    def test_record_time_uses_restaurant_clock(self, monkeypatch):
+        monkeypatch.setattr(cold_start, "RESTAURANT_TIMEZONE", "America/New_York")
+        # Logged in UTC, served at 18:00 New York time
+        assert replay_eval._record_datetime("2024-01-01T23:00:00") == datetime(2024, 1, 1, 18)
+        assert replay_eval._record_datetime("2024-01-01T23:00:00+00:00") == datetime(2024, 1, 1, 18)
+
+    def test_plan_shards(self, request_log):
+        size = request_log.stat().st_size
+        shards = replay_eval.plan_shards([request_log], 100)
+        assert shards[0][1] == 0
+        assert shards[-1][2] == size
+        assert len(shards) == -(-size // 100)
+
+class TestReplayHarness:
+    """Test replaying logs against multiple candidates."""
+
+    @pytest.mark.parametrize("shard_bytes", [37, replay_eval.SHARD_BYTES])
+    def test_side_by_side_report(self, history, request_log, shard_bytes):
+        report = replay_eval.run_replay(
+            [request_log],
+            ["current=replay_eval:CurrentScorer", "reversed=test_replay_eval:ReversedScorer"],
+            history_dir=history, workers=2, shard_bytes=shard_bytes, cold_start_table=snapshot_table(),
+        )
+
+        current, reverse = report["current"], report["reversed"]
+        assert current["recommendations"]["requests"] == 3
+        assert current["recommendations"]["judged"] == 2
+        # Users 1 and 2 had not ordered yet, so they are served from the table. At 18:00
+        # on Monday "7" is closed, so the ranking is 2, 5, 9: user 1 ordered from the
+        # first-ranked restaurant and user 2 from the second
+        assert current["recommendations"]["ndcg@10"] == pytest.approx((1 + 0.6309) / 2, abs=1e-4)
+        assert reverse["recommendations"]["ndcg@10"] == pytest.approx((0.5 + 0.6309) / 2, abs=1e-4)
+        assert current["recommendations"]["recall@10"] == 1.0
+
+        assert current["chat"]["requests"] == 3
+        assert current["chat"]["accuracy"] == 1.0
+        assert current["chat"]["agreement"] is None
+        assert reverse["chat"]["accuracy"] == 0.5
+        assert reverse["chat"]["agreement"] == pytest.approx(1 / 3, abs=1e-4)
+
+        assert current["sentiment"]["labelled"] == 3
+        assert current["sentiment"]["accuracy"] == 1.0
+        assert reverse["sentiment"]["accuracy"] == pytest.approx(1 / 3, abs=1e-4)
+
+        latency = current["chat"]["latency_ms"]
+        assert 0 < latency["p50"] <= latency["p99"] <= latency["max"]
+
+        table = replay_eval.format_report(report)
+        assert "current" in table.splitlines()[0]
+        assert "recommendations ndcg@10" in table
+
+    def test_unknown_candidate_fails_fast(self, request_log):
+        with pytest.raises((ImportError, AttributeError)):
+            replay_eval.run_replay([request_log], ["bad=replay_eval:Missing"], history_dir=None)
+
+class TestRequestLogging:
+    """Test that served requests are recorded for replay."""
+
+    def test_requests_are_logged(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(main, "request_logger", RequestLogger(tmp_path, batch_size=2))
+        client.post("/chat/support", json={"message": "hello"})
+        assert list(tmp_path.iterdir()) == []
+        client.post("/analytics/sentiment", json={"reviews": ["good"]})
+
+        (log_file,) = tmp_path.iterdir()
+        records = [json.loads(line) for line in log_file.read_text().splitlines()]
+        assert [r["endpoint"] for r in records] == ["chat", "sentiment"]
+        assert records[1]["request"] == {"reviews": ["good"]}
+
+    def test_disabled_without_directory(self):
+        logger = RequestLogger(None)
+        assert logger.log("chat", {"message": "hi"}) is False
+        assert logger.flush() == 0
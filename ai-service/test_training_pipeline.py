@@ -0,0 +1,183 @@
+import os
+import pytest
+from datetime import datetime
+from fastapi.testclient import TestClient
+
+import main
+import model_store
+import training_pipeline
+from training_pipeline import PartitionWriter, partition_key, read_manifest, write_manifest
+
+client = TestClient(main.app)
+
+def write_history(history_dir, tables):
+    """Write rows into partitioned tables and record them in the history manifest."""
+    manifest = read_manifest(history_dir)
+    for table, rows in tables.items():
+        writer = PartitionWriter(history_dir / table, chunk_rows=2)
+        for row in rows:
+            time_field = "timestamp" if table == "events" else "created_at"
+            writer.add(partition_key(row["restaurant_id"], row[time_field]), row)
+        for key, digest in writer.close().items():
+            manifest["partitions"][f"{table}/{key}"] = digest
+    write_manifest(history_dir, manifest)
+
+def order(order_id, restaurant_id, created_at, total=20.0, delivered_after=None):
+    created = datetime.fromisoformat(created_at)
+    delivered = created.replace(minute=created.minute + delivered_after) if delivered_after else None
+    return {
+        "order_id": order_id, "customer_id": "c1", "restaurant_id": restaurant_id, "status": "delivered",
+        "total_amount": total, "created_at": created, "estimated_delivery_time": None,
+        "actual_delivery_time": delivered,
+    }
+
+@pytest.fixture
+def history(tmp_path):
+    history_dir = tmp_path / "history"
+    write_history(history_dir, {
+        "orders": [
+            order("o1", "r1", "2024-01-01T12:00:00", delivered_after=30),
+            order("o2", "r1", "2024-01-01T12:10:00", delivered_after=20),
+            order("o3", "r1", "2024-01-01T19:00:00"),
+            order("o4", "r1", "2024-01-02T12:00:00"),
+            order("o5", "r2", "2024-01-01T18:00:00"),
+        ],
+        "order_items": [
+            {"order_id": "o1", "menu_item_id": "m1", "quantity": 2, "unit_price": 5.0, "total_price": 10.0,
+             "customer_id": "c1", "restaurant_id": "r1", "created_at": datetime(2024, 1, 1, 12)},
+            {"order_id": "o2", "menu_item_id": "m2", "quantity": 1, "unit_price": 8.0, "total_price": 8.0,
+             "customer_id": "c1", "restaurant_id": "r1", "created_at": datetime(2024, 1, 1, 12, 10)},
+        ],
+        "reviews": [
+            {"review_id": "v1", "customer_id": "c1", "restaurant_id": "r1", "order_id": "o1", "rating": 4,
+             "created_at": datetime(2024, 1, 1, 13)},
+        ],
+        "events": [
+            {"user_id": 1, "session_id": "s", "event_type": "view_restaurant", "timestamp": datetime(2024, 1, 1, 11),
+             "restaurant_id": "r1", "metadata": "{}"},
+            {"user_id": 1, "session_id": "s", "event_type": "place_order", "timestamp": datetime(2024, 1, 1, 12),
+             "restaurant_id": "r1", "metadata": "{}"},
+        ],
+    })
+    return history_dir
+
+class TestPartitionWriter:
+    """Test partitioned Parquet export."""
+
+    def test_writes_parts_per_partition(self, history):
+        partition = history / "orders" / "restaurant_id=r1" / "date=2024-01-01"
+        assert sorted(p.name for p in partition.iterdir()) == ["part-00000.parquet", "part-00001.parquet"]
+        assert not list(history.rglob("*.staging"))
+
+    def test_rewrite_replaces_partition(self, history):
+        write_history(history, {"orders": [order("o9", "r1", "2024-01-01T09:00:00")]})
+        partition = history / "orders" / "restaurant_id=r1" / "date=2024-01-01"
+        assert [p.name for p in partition.iterdir()] == ["part-00000.parquet"]
+
+    def test_one_part_per_grouped_partition(self, tmp_path):
+        writer = PartitionWriter(tmp_path / "orders", chunk_rows=50)
+        for restaurant in range(20):
+            for day in (1, 2, 3):
+                for i in range(10):
+                    row = order(f"o{restaurant}-{day}-{i}", f"r{restaurant}", f"2024-01-0{day}T12:0{i}:00")
+                    writer.add(partition_key(row["restaurant_id"], row["created_at"]), row)
+        written = writer.close()
+        assert len(written) == 60
+        assert len(list((tmp_path / "orders").rglob("*.parquet"))) == 60
+
+    def test_exports_are_ordered_by_partition(self):
+        for _, query, alias, _ in training_pipeline.POSTGRES_EXPORTS:
+            assert f"ORDER BY {alias}.restaurant_id, {alias}.created_at" in query
+
+    def test_leftover_old_partition_is_removed(self, history):
+        partition = history / "orders" / "restaurant_id=r1" / "date=2024-01-01"
+        leftover = partition.with_name("date=2024-01-01.old")
+        leftover.mkdir()
+        (leftover / "part-00000.parquet").write_bytes(b"stale")
+
+        write_history(history, {"orders": [order("o9", "r1", "2024-01-01T09:00:00")]})
+        assert not leftover.exists()
+        assert [p.name for p in partition.iterdir()] == ["part-00000.parquet"]
+
+    def test_missing_live_partition_is_restored(self, history):
+        partition = history / "orders" / "restaurant_id=r1" / "date=2024-01-01"
+        retired = partition.with_name("date=2024-01-01.old")
+        # Simulate a crash between moving the live partition aside and swapping in the new one
+        os.rename(partition, retired)
+
+        PartitionWriter(history / "orders")
+        assert partition.is_dir()
+        assert not retired.exists()
+        assert len(list(partition.iterdir())) == 2
+
+class TestFeatureExtraction:
+    """Test parallel, incremental feature extraction."""
+
+    def test_extract_partition_features(self, history):
+        features = training_pipeline.extract_partition_features(history, "restaurant_id=r1/date=2024-01-01", 1)
+        assert features["orders"] == 3
+        assert features["hourly_orders"][12] == 2
+        assert features["hourly_orders"][19] == 1
+        assert features["delivery_count"] == 2
+        assert features["delivery_minutes_sum"] == 50
+        assert features["items"] == {"m1": (2, 10.0), "m2": (1, 8.0)}
+        assert features["rating_count"] == 1
+        assert features["events"] == {"view_restaurant": 1, "place_order": 1}
+
+    def test_only_changed_partitions_are_reprocessed(self, history, tmp_path):
+        feature_dir = tmp_path / "features"
+        processed = training_pipeline.run_feature_extraction(history, feature_dir, workers=2)
+        assert len(processed) == 3
+
+        assert training_pipeline.run_feature_extraction(history, feature_dir, workers=2) == []
+
+        write_history(history, {"orders": [order("o6", "r2", "2024-01-01T18:30:00")]})
+        processed = training_pipeline.run_feature_extraction(history, feature_dir, workers=2)
+        assert processed == ["restaurant_id=r2/date=2024-01-01"]
+
+class TestTraining:
+    """Test model artifacts produced from features."""
+
+    def test_train_models_publishes_artifacts(self, history, tmp_path):
+        feature_dir = tmp_path / "features"
+        model_dir = tmp_path / "models"
+        training_pipeline.run_feature_extraction(history, feature_dir, workers=1)
+        versions = training_pipeline.train_models(feature_dir, model_dir)
+        assert set(versions) == set(model_store.MODEL_NAMES)
+
+        models = model_store.load_models(model_dir)
+        demand = models["demand"]["model"]["r1"]
+        assert demand["days"] == 2
+        assert demand["hourly_orders"][12] == 1.5
+        assert models["eta"]["model"]["r1"]["avg_delivery_minutes"] == 25.0
+        assert models["recommendations"]["model"]["r1"]["conversion_rate"] == 1.0
+        assert models["recommendations"]["model"]["r1"]["top_menu_items"] == ["m1", "m2"]
+        assert models["pricing"]["model"]["m1"]["avg_price"] == 5.0
+
+    def test_save_artifact_updates_latest(self, tmp_path):
+        model_store.save_artifact("demand", {"a": 1}, tmp_path)
+        version = model_store.save_artifact("demand", {"a": 2}, tmp_path)
+        artifact = model_store.load_latest("demand", tmp_path)
+        assert artifact["version"] == version
+        assert artifact["model"] == {"a": 2}
+        assert model_store.load_latest("eta", tmp_path) is None
+
+    def test_demand_forecast_uses_trained_model(self, monkeypatch):
+        restaurant_id = "3f1c2b7e-8d4a-4c1e-9f6b-2a5d7e9c1b3a"
+        hourly = [0.0] * 24
+        for hour in (11, 12, 18, 19):
+            hourly[hour] = 5.0
+        monkeypatch.setattr(main, "trained_models", {
+            "demand": {"name": "demand", "version": "v1", "model": {restaurant_id: {"hourly_orders": hourly, "days": 28}}}
+        })
+
+        data = client.get(f"/analytics/demand-forecast?restaurant_id={restaurant_id}&hours_ahead=24").json()
+        assert data["restaurant_id"] == restaurant_id
+        assert data["peak_hours"] == [11, 12, 18, 19]
+        assert data["model_version"] == "v1"
+        assert data["confidence"] == 0.8
+        assert sum(p["orders"] for p in data["predicted_orders"]) == 20.0
+
+        data = client.get("/analytics/demand-forecast?restaurant_id=8").json()
+        assert data["restaurant_id"] == 8
+        assert "model_version" not in data
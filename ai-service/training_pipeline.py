@@ -0,0 +1,484 @@
+"""
+Offline training pipeline for the AI service models.
+
+Exports order history from Postgres and ``user_analytics`` events from Mongo into
+Parquet partitioned by restaurant and date, extracts features from each partition
+in a process pool, and publishes versioned model artifacts that ``main.py`` loads
+on startup::
+
+    python training_pipeline.py export     # stream new/changed history to Parquet
+    python training_pipeline.py features   # re-extract partitions that changed
+    python training_pipeline.py train      # reduce features into model artifacts
+    python training_pipeline.py run        # all of the above
+
+Every stage is incremental: exports only rewrite partitions touched since the
+last watermark, and feature extraction skips partitions whose content hash has
+not changed. Reads and writes go through fixed-size chunks so peak memory does
+not grow with the size of the history.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import db
+from model_store import MODEL_DIR, atomic_write_text, save_artifact
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_DIR = os.getenv("HISTORY_DIR", os.path.join(BASE_DIR, "data", "history"))
+FEATURE_DIR = os.getenv("FEATURE_DIR", os.path.join(BASE_DIR, "data", "features"))
+CHUNK_ROWS = 50000
+MANIFEST_FILE = "_manifest.json"
+NO_RESTAURANT = "_none"
+
+ORDERS_QUERY = """
+    SELECT o.id AS order_id, o.customer_id, o.restaurant_id, o.status, o.total_amount,
+           o.created_at, o.estimated_delivery_time, o.actual_delivery_time
+    FROM orders o
+    {where}
+    ORDER BY o.restaurant_id, o.created_at, o.id
+"""
+
+ORDER_ITEMS_QUERY = """
+    SELECT oi.order_id, oi.menu_item_id, oi.quantity, oi.unit_price, oi.total_price,
+           o.customer_id, o.restaurant_id, o.created_at
+    FROM order_items oi
+    JOIN orders o ON o.id = oi.order_id
+    {where}
+    ORDER BY o.restaurant_id, o.created_at, oi.order_id, oi.id
+"""
+
+REVIEWS_QUERY = """
+    SELECT r.id AS review_id, r.customer_id, r.restaurant_id, r.order_id, r.rating, r.created_at
+    FROM reviews r
+    {where}
+    ORDER BY r.restaurant_id, r.created_at, r.id
+"""
+
+# Exports are ordered by restaurant and time so each partition arrives as one
+# contiguous run of rows (see PartitionWriter) and in the same order every run.
+
+# Re-export whole partitions that contain any row updated since the watermark
+INCREMENTAL_WHERE = """
+    WHERE ({alias}.restaurant_id, {alias}.created_at::date) IN (
+        SELECT restaurant_id, created_at::date FROM {source} WHERE updated_at > %(since)s
+    )
+"""
+
+# (table, query, alias of the partitioning table, table whose updated_at marks changes)
+POSTGRES_EXPORTS = (
+    ("orders", ORDERS_QUERY, "o", "orders"),
+    ("order_items", ORDER_ITEMS_QUERY, "o", "orders"),
+    ("reviews", REVIEWS_QUERY, "r", "reviews"),
+)
+
+
+def partition_key(restaurant_id, day) -> str:
+    """Relative path of a restaurant/date partition."""
+    if isinstance(day, datetime):
+        day = day.date()
+    if isinstance(day, date):
+        day = day.isoformat()
+    return f"restaurant_id={restaurant_id or NO_RESTAURANT}/date={day}"
+
+
+def parse_partition_key(key: str):
+    """Split a partition key back into (restaurant_id, date string)."""
+    restaurant_part, date_part = key.split("/")
+    return restaurant_part.split("=", 1)[1], date_part.split("=", 1)[1]
+
+
+def read_manifest(directory) -> dict:
+    manifest = {"watermark": None, "partitions": {}}
+    try:
+        with open(Path(directory) / MANIFEST_FILE) as f:
+            manifest.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def write_manifest(directory, manifest: dict):
+    atomic_write_text(Path(directory) / MANIFEST_FILE, json.dumps(manifest, indent=2, sort_keys=True))
+
+
+class PartitionWriter:
+    """
+    Write the rows of one table into restaurant/date partitions.
+
+    Rows are expected grouped by partition (the exports sort by restaurant and
+    time): the current partition's rows are buffered and written as a numbered
+    Parquet part every ``chunk_rows`` rows and when the key changes, so at most
+    one partition is held in memory. Parts are staged next to the live partition
+    and swapped in by ``close()``, which returns the content hash of every
+    partition written.
+    """
+
+    def __init__(self, table_dir, chunk_rows: int = CHUNK_ROWS):
+        self.table_dir = Path(table_dir)
+        self.chunk_rows = chunk_rows
+        self._key = None
+        self._rows = []
+        self._parts = defaultdict(int)
+        self._hashes = {}
+        self.recover_all()
+
+    def add(self, key: str, row: dict):
+        if key != self._key:
+            self._flush()
+            self._key = key
+        self._rows.append(row)
+        if len(self._rows) >= self.chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        key, rows = self._key, self._rows
+        self._rows = []
+        staging = self.table_dir / f"{key}.staging"
+        if self._parts[key] == 0 and staging.exists():
+            # Left over from an interrupted run
+            shutil.rmtree(staging)
+        staging.mkdir(parents=True, exist_ok=True)
+
+        sink = io.BytesIO()
+        pq.write_table(pa.Table.from_pylist(rows), sink)
+        data = sink.getvalue()
+        with open(staging / f"part-{self._parts[key]:05d}.parquet", "wb") as f:
+            f.write(data)
+        self._parts[key] += 1
+        self._hashes.setdefault(key, hashlib.sha256()).update(data)
+
+    def close(self) -> dict:
+        self._flush()
+        for key in self._hashes:
+            live = self.table_dir / key
+            staging = self.table_dir / f"{key}.staging"
+            retired = self.table_dir / f"{key}.old"
+            self._recover(live, retired)
+            if live.exists():
+                os.rename(live, retired)
+                os.rename(staging, live)
+                shutil.rmtree(retired)
+            else:
+                os.rename(staging, live)
+        return {key: digest.hexdigest() for key, digest in self._hashes.items()}
+
+    @staticmethod
+    def _recover(live: Path, retired: Path):
+        """Repair a swap interrupted by a crash, leaving at most the live partition."""
+        if not retired.exists():
+            return
+        if live.exists():
+            # Died after the new partition went live; the old copy is just garbage
+            shutil.rmtree(retired)
+        else:
+            # Died between the two renames; put the previous partition back
+            os.rename(retired, live)
+
+    def recover_all(self):
+        """Repair every interrupted swap under this table, e.g. before reading it."""
+        for retired in self.table_dir.glob("restaurant_id=*/date=*.old"):
+            self._recover(retired.with_name(retired.name[:-len(".old")]), retired)
+
+
+def _normalize_row(row: dict) -> dict:
+    normalized = {}
+    for column, value in row.items():
+        if isinstance(value, Decimal):
+            value = float(value)
+        elif isinstance(value, uuid.UUID):
+            value = str(value)
+        normalized[column] = value
+    normalized["restaurant_id"] = str(normalized["restaurant_id"]) if normalized.get("restaurant_id") else NO_RESTAURANT
+    return normalized
+
+
+def export_postgres(conn, history_dir, since=None, chunk_rows: int = CHUNK_ROWS) -> dict:
+    """Stream orders, order items and reviews into partitions with server-side cursors."""
+    hashes = {}
+    for table, query, alias, source in POSTGRES_EXPORTS:
+        where = INCREMENTAL_WHERE.format(alias=alias, source=source) if since else ""
+        writer = PartitionWriter(Path(history_dir) / table, chunk_rows)
+        with conn.cursor(name=f"export_{table}") as cur:
+            cur.itersize = chunk_rows
+            cur.execute(query.format(where=where), {"since": since})
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                for row in rows:
+                    row = _normalize_row(row)
+                    writer.add(partition_key(row["restaurant_id"], row["created_at"]), row)
+        conn.rollback()
+        written = writer.close()
+        hashes.update({f"{table}/{key}": digest for key, digest in written.items()})
+        logger.info("Exported %d %s partitions", len(written), table)
+    return hashes
+
+
+def export_events(mongo_db, history_dir, since=None, chunk_rows: int = CHUNK_ROWS) -> dict:
+    """Stream ``user_analytics`` events into partitions by the restaurant in their metadata."""
+    query = {}
+    if since:
+        # Events are append-only, so only days from the watermark onwards can change
+        query = {"timestamp": {"$gte": since.replace(hour=0, minute=0, second=0, microsecond=0)}}
+    projection = {"_id": 0, "user_id": 1, "session_id": 1, "event_type": 1, "timestamp": 1, "metadata": 1}
+
+    writer = PartitionWriter(Path(history_dir) / "events", chunk_rows)
+    cursor = mongo_db["user_analytics"].find(query, projection, batch_size=chunk_rows, allow_disk_use=True)
+    cursor.sort([("metadata.restaurant_id", 1), ("timestamp", 1), ("_id", 1)])
+    for doc in cursor:
+        metadata = doc.get("metadata") or {}
+        restaurant_id = metadata.get("restaurant_id")
+        row = {
+            "user_id": doc.get("user_id"),
+            "session_id": doc.get("session_id"),
+            "event_type": doc["event_type"],
+            "timestamp": doc["timestamp"],
+            "restaurant_id": str(restaurant_id) if restaurant_id is not None else NO_RESTAURANT,
+            "metadata": json.dumps(metadata, default=str),
+        }
+        writer.add(partition_key(row["restaurant_id"], row["timestamp"]), row)
+    written = writer.close()
+    logger.info("Exported %d events partitions", len(written))
+    return {f"events/{key}": digest for key, digest in written.items()}
+
+
+def export_history(history_dir=HISTORY_DIR, chunk_rows: int = CHUNK_ROWS, full: bool = False) -> int:
+    """Export history changed since the last run. Returns the number of partitions written."""
+    manifest = read_manifest(history_dir)
+    since = None if full or not manifest["watermark"] else datetime.fromisoformat(manifest["watermark"])
+    started = datetime.now(timezone.utc)
+
+    conn = db.get_postgres_connection()
+    mongo_db = db.get_mongo_database()
+    if conn is None or mongo_db is None:
+        raise RuntimeError("DATABASE_URL and MONGODB_URI must be set and their drivers installed")
+
+    try:
+        hashes = export_postgres(conn, history_dir, since, chunk_rows)
+    finally:
+        conn.close()
+    hashes.update(export_events(mongo_db, history_dir, since, chunk_rows))
+
+    manifest["partitions"].update(hashes)
+    manifest["watermark"] = started.isoformat()
+    write_manifest(history_dir, manifest)
+    return len(hashes)
+
+
+def partition_fingerprints(partitions: dict) -> dict:
+    """Combine per-table partition hashes into one fingerprint per restaurant/date."""
+    by_key = defaultdict(list)
+    for path, digest in sorted(partitions.items()):
+        table, key = path.split("/", 1)
+        by_key[key].append(f"{table}:{digest}")
+    return {key: hashlib.sha256("|".join(parts).encode()).hexdigest() for key, parts in by_key.items()}
+
+
+def iter_partition_batches(partition_dir, columns, batch_rows: int = CHUNK_ROWS):
+    """Yield record batches of a partition as DataFrames, one bounded batch at a time."""
+    partition_dir = Path(partition_dir)
+    if not partition_dir.is_dir():
+        return
+    for part in sorted(partition_dir.glob("part-*.parquet")):
+        parquet_file = pq.ParquetFile(part)
+        present = [c for c in columns if c in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=present):
+            yield batch.to_pandas().reindex(columns=columns)
+
+
+def extract_partition_features(history_dir, key: str, batch_rows: int = CHUNK_ROWS) -> dict:
+    """Aggregate one restaurant/date partition across all exported tables."""
+    history_dir = Path(history_dir)
+    restaurant_id, day = parse_partition_key(key)
+    features = {
+        "restaurant_id": restaurant_id,
+        "date": day,
+        "orders": 0,
+        "hourly_orders": [0] * 24,
+        "revenue": 0.0,
+        "delivery_minutes_sum": 0.0,
+        "delivery_count": 0,
+        "rating_sum": 0,
+        "rating_count": 0,
+        "items": {},
+        "events": {},
+    }
+
+    for df in iter_partition_batches(history_dir / "orders" / key,
+                                     ["created_at", "total_amount", "actual_delivery_time"], batch_rows):
+        created = pd.to_datetime(df["created_at"])
+        delivered = pd.to_datetime(df["actual_delivery_time"])
+        features["orders"] += len(df)
+        for hour, count in created.dt.hour.value_counts().items():
+            features["hourly_orders"][int(hour)] += int(count)
+        features["revenue"] += float(pd.to_numeric(df["total_amount"]).fillna(0).sum())
+        minutes = ((delivered - created).dt.total_seconds() / 60).dropna()
+        features["delivery_minutes_sum"] += float(minutes.sum())
+        features["delivery_count"] += int(minutes.count())
+
+    for df in iter_partition_batches(history_dir / "order_items" / key,
+                                     ["menu_item_id", "quantity", "total_price"], batch_rows):
+        totals = df.groupby("menu_item_id")[["quantity", "total_price"]].sum()
+        for item_id, row in totals.iterrows():
+            quantity, revenue = features["items"].get(str(item_id), (0, 0.0))
+            features["items"][str(item_id)] = (quantity + int(row["quantity"]), revenue + float(row["total_price"]))
+
+    for df in iter_partition_batches(history_dir / "reviews" / key, ["rating"], batch_rows):
+        ratings = pd.to_numeric(df["rating"]).dropna()
+        features["rating_sum"] += int(ratings.sum())
+        features["rating_count"] += int(ratings.count())
+
+    for df in iter_partition_batches(history_dir / "events" / key, ["event_type"], batch_rows):
+        for event_type, count in df["event_type"].value_counts().items():
+            features["events"][event_type] = features["events"].get(event_type, 0) + int(count)
+
+    return features
+
+
+def _extract_worker(history_dir: str, feature_dir: str, key: str, batch_rows: int) -> str:
+    features = extract_partition_features(history_dir, key, batch_rows)
+    atomic_write_text(Path(feature_dir) / f"{key}.json", json.dumps(features))
+    return key
+
+
+def run_feature_extraction(history_dir=HISTORY_DIR, feature_dir=FEATURE_DIR, workers: int = None,
+                           batch_rows: int = CHUNK_ROWS, force: bool = False) -> list:
+    """
+    Extract features for every partition whose content changed since the last run,
+    one partition per worker process. Returns the keys that were processed.
+    """
+    fingerprints = partition_fingerprints(read_manifest(history_dir)["partitions"])
+    feature_manifest = read_manifest(feature_dir)
+    done = feature_manifest["partitions"]
+    stale = [key for key, fingerprint in sorted(fingerprints.items()) if force or done.get(key) != fingerprint]
+    if not stale:
+        return []
+
+    processed = []
+    try:
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            futures = {
+                pool.submit(_extract_worker, str(history_dir), str(feature_dir), key, batch_rows): key
+                for key in stale
+            }
+            for future in as_completed(futures):
+                key = future.result()
+                done[key] = fingerprints[key]
+                processed.append(key)
+    finally:
+        # Record finished partitions even if a worker failed, so a re-run resumes
+        write_manifest(feature_dir, feature_manifest)
+    logger.info("Extracted features for %d of %d partitions", len(processed), len(fingerprints))
+    return processed
+
+
+def train_models(feature_dir=FEATURE_DIR, model_dir=None) -> dict:
+    """Reduce per-partition features into the published models. Returns {name: version}."""
+    feature_dir = Path(feature_dir)
+    restaurants = defaultdict(lambda: {
+        "orders": 0, "hourly_orders": [0] * 24, "first_date": None, "last_date": None,
+        "delivery_minutes_sum": 0.0, "delivery_count": 0, "rating_sum": 0, "rating_count": 0,
+        "events": defaultdict(int), "items": defaultdict(lambda: [0, 0.0]),
+    })
+
+    for key in sorted(read_manifest(feature_dir)["partitions"]):
+        try:
+            with open(feature_dir / f"{key}.json") as f:
+                features = json.load(f)
+        except FileNotFoundError:
+            continue
+        if features["restaurant_id"] == NO_RESTAURANT:
+            continue
+        totals = restaurants[features["restaurant_id"]]
+        totals["orders"] += features["orders"]
+        totals["hourly_orders"] = [a + b for a, b in zip(totals["hourly_orders"], features["hourly_orders"])]
+        if features["orders"]:
+            totals["first_date"] = min(filter(None, (totals["first_date"], features["date"])))
+            totals["last_date"] = max(filter(None, (totals["last_date"], features["date"])))
+        for field in ("delivery_minutes_sum", "delivery_count", "rating_sum", "rating_count"):
+            totals[field] += features[field]
+        for event_type, count in features["events"].items():
+            totals["events"][event_type] += count
+        for item_id, (quantity, revenue) in features["items"].items():
+            totals["items"][item_id][0] += quantity
+            totals["items"][item_id][1] += revenue
+
+    demand, eta, recommendations, pricing = {}, {}, {}, {}
+    for restaurant_id, totals in restaurants.items():
+        if totals["first_date"]:
+            days = (date.fromisoformat(totals["last_date"]) - date.fromisoformat(totals["first_date"])).days + 1
+            demand[restaurant_id] = {
+                "hourly_orders": [round(count / days, 3) for count in totals["hourly_orders"]],
+                "days": days,
+            }
+        if totals["delivery_count"]:
+            eta[restaurant_id] = {
+                "avg_delivery_minutes": round(totals["delivery_minutes_sum"] / totals["delivery_count"], 1),
+                "deliveries": totals["delivery_count"],
+            }
+        views = totals["events"].get("view_restaurant", 0)
+        top_items = sorted(totals["items"].items(), key=lambda item: item[1][0], reverse=True)[:5]
+        recommendations[restaurant_id] = {
+            "orders": totals["orders"],
+            "avg_rating": round(totals["rating_sum"] / totals["rating_count"], 2) if totals["rating_count"] else None,
+            "conversion_rate": round(totals["events"].get("place_order", 0) / views, 4) if views else None,
+            "top_menu_items": [item_id for item_id, _ in top_items],
+        }
+        for item_id, (quantity, revenue) in totals["items"].items():
+            if quantity:
+                pricing[item_id] = {
+                    "restaurant_id": restaurant_id,
+                    "quantity": quantity,
+                    "avg_price": round(revenue / quantity, 2),
+                }
+
+    models = {"demand": demand, "eta": eta, "recommendations": recommendations, "pricing": pricing}
+    return {name: save_artifact(name, payload, model_dir) for name, payload in models.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline training pipeline for the AI service models")
+    parser.add_argument("stage", choices=["export", "features", "train", "run"])
+    parser.add_argument("--history-dir", default=HISTORY_DIR)
+    parser.add_argument("--feature-dir", default=FEATURE_DIR)
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="feature worker processes (default: CPU count)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="rows per read/write chunk")
+    parser.add_argument("--full", action="store_true", help="ignore the watermark and re-export everything")
+    parser.add_argument("--force", action="store_true", help="re-extract features for every partition")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.stage in ("export", "run"):
+        export_history(args.history_dir, args.chunk_rows, full=args.full)
+    if args.stage in ("features", "run"):
+        run_feature_extraction(args.history_dir, args.feature_dir, args.workers, args.chunk_rows,
+                               force=args.force or args.full)
+    if args.stage in ("train", "run"):
+        versions = train_models(args.feature_dir, args.model_dir)
+        for name, version in versions.items():
+            logger.info("Published %s model version %s", name, version)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,8 +10,9 @@ db.createCollection('chat_messages', {
       bsonType: 'object',
       required: ['order_id', 'sender_id', 'sender_type', 'message', 'timestamp'],
       properties: {
-        order_id: { bsonType: 'int' },
-        sender_id: { bsonType: 'int' },
+        // Postgres orders.id / users.id are UUIDs, stored here as strings
+        order_id: { bsonType: ['int', 'string'] },
+        sender_id: { bsonType: ['int', 'string'] },
         sender_type: { 
           bsonType: 'string',
           enum: ['customer', 'driver', 'restaurant', 'support']